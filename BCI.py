@@ -1,11 +1,163 @@
-from typing import Dict
+from typing import Dict, List, Tuple
+from collections import OrderedDict
+import bisect
 import json
 import logging
 
-import matplotlib.pyplot as plt
+import numpy as np
+
+from CostModel import CostModel, parse_cost_model
+from MarketData import MarketData
+from Instrumentation import Timings
+from Trace import RebalanceRecord, TraceWriter
 
 LOG = logging.getLogger(__name__)
 
+# parameters which have to match when resuming a simulation from a checkpoint
+CHECKPOINT_PARAMETERS = ['index_size', 'rebalancing_period', 'primary_usd_filtering', 'secondary_usd_filtering',
+                         'max_asset_allocation', 'fee', 'running_avg_volume_period', 'index_candidate_size',
+                         'primary_candidate_size', 'secondary_candidate_size', 'offset', 'cost_model', 'deduct_fee']
+
+# parameters the selection of index coins depends on besides the date and coins of the current portfolio
+SELECTION_PARAMETERS = ['offset', 'index_size', 'index_candidate_size', 'primary_candidate_size',
+                        'secondary_candidate_size', 'primary_usd_filtering', 'secondary_usd_filtering']
+
+# maximal number of iterations and relative tolerance of the portfolio value when deducting fees from the portfolio
+FEE_DEDUCTION_ITERATIONS = 20
+FEE_DEDUCTION_TOLERANCE = 1e-12
+
+# maximal number of selections kept by the cache shared by all simulations of the process
+SELECTION_CACHE_SIZE = 100000
+
+
+class SelectionCache(object):
+    # bounded cache of index selections (candidates, composition) with LRU eviction
+    def __init__(self, max_size: int = SELECTION_CACHE_SIZE):
+        self.max_size = max_size
+        self.selections: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple) -> Tuple:
+        selection = self.selections.get(key)
+        if selection is None:
+            self.misses += 1
+            return None
+
+        self.selections.move_to_end(key)
+        self.hits += 1
+        return selection
+
+    def put(self, key: Tuple, selection: Tuple):
+        self.selections[key] = selection
+        if len(self.selections) > self.max_size:
+            self.selections.popitem(last = False)
+
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses > 0 else 0
+
+    def clear(self):
+        self.selections.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+SELECTION_CACHE = SelectionCache()
+
+
+# values of N portfolios over a range of dates where portfolio k holds qty[k, j] units of coin in column cols[k, j].
+# Positions are accumulated one by one in their order, so the value of a portfolio does not depend on how many
+# portfolios are evaluated together.
+def calc_portfolio_values(price: np.ndarray, cols: np.ndarray, qty: np.ndarray) -> np.ndarray:
+    values = np.zeros((price.shape[0], cols.shape[0]))
+    for j in range(cols.shape[1]):
+        values += price[:, cols[:, j]] * qty[:, j]
+
+    return values
+
+
+# cap normalized weights (last axis, e.g. (configurations, assets)) at max_allocation and redistribute the surplus
+# among the uncapped assets proportionally to their weights (water-filling). Assets are processed from the largest
+# weight, the k largest ones are capped where k is the smallest number for which the next largest asset stays
+# within the cap after redistribution. If all assets have to be capped, the surplus is not redistributed at all.
+def calc_capped_weights(weights: np.ndarray, max_allocation) -> np.ndarray:
+    weights = np.asarray(weights, dtype = np.float64)
+    max_allocation = np.asarray(max_allocation, dtype = np.float64)[..., np.newaxis]
+    n = weights.shape[-1]
+
+    order = np.argsort(-weights, axis = -1, kind = 'stable')
+    sorted_weights = np.take_along_axis(weights, order, axis = -1)
+    tail_sums = np.cumsum(sorted_weights[..., ::-1], axis = -1)[..., ::-1]
+
+    # number of capped assets, an extra column for the case all assets are capped
+    k = np.arange(n)
+    within_cap = (1 - k * max_allocation) * sorted_weights <= max_allocation * tail_sums
+    within_cap = np.concatenate([within_cap, np.ones(within_cap.shape[:-1] + (1,), dtype = bool)], axis = -1)
+    capped = np.argmax(within_cap, axis = -1)[..., np.newaxis]
+
+    # remaining allocation distributed among the uncapped assets, weights stay untouched if nothing is capped
+    tail_sum = np.take_along_axis(np.concatenate([tail_sums, np.zeros(tail_sums.shape[:-1] + (1,))], axis = -1), capped, axis = -1)
+    scale = np.divide(1 - capped * max_allocation, tail_sum, out = np.zeros(tail_sum.shape), where = tail_sum > 0)
+    uncapped = np.where(capped == 0, sorted_weights, sorted_weights * scale)
+
+    result = np.empty(weights.shape)
+    np.put_along_axis(result, order, np.where(k < capped, max_allocation, uncapped), axis = -1)
+
+    return result
+
+
+class Portfolio(object):
+    # holdings of coins given by their columns (int32 IDs) in the order of allocation. Names of the coins are needed
+    # only when presenting the portfolio or storing it into a checkpoint.
+    def __init__(self, cols: np.ndarray = None, qty: np.ndarray = None):
+        self.cols = cols if cols is not None else np.zeros(0, dtype = np.int32)
+        self.qty = qty if qty is not None else np.zeros(0)
+
+    def __len__(self) -> int:
+        return len(self.cols)
+
+    def copy(self) -> 'Portfolio':
+        return Portfolio(self.cols.copy(), self.qty.copy())
+
+    # quantities held of coins in the given columns, zero for coins not in the portfolio
+    def quantities(self, cols: np.ndarray) -> np.ndarray:
+        qty = np.zeros(len(cols))
+        if len(self.cols) > 0:
+            order = np.argsort(self.cols)
+            pos = order[np.minimum(np.searchsorted(self.cols, cols, sorter = order), len(self.cols) - 1)]
+            held = self.cols[pos] == cols
+            qty[held] = self.qty[pos[held]]
+
+        return qty
+
+    def to_dict(self, coins: List[str]) -> Dict[str, float]:
+        return {coins[col]: qty for (col, qty) in zip(self.cols.tolist(), self.qty.tolist())}
+
+    @classmethod
+    def from_dict(cls, portfolio: Dict[str, float], coin_index: Dict[str, int]) -> 'Portfolio':
+        return cls(np.array([coin_index[coin] for coin in portfolio.keys()], dtype = np.int32),
+                   np.array(list(portfolio.values()), dtype = np.float64))
+
+
+# check consistency of BCI parameters, raises an exception for an invalid configuration
+def validate_configuration(configuration: Dict):
+    if configuration['index_candidate_size'] < configuration['index_size']:
+        raise Exception(f"Index candidate size [{configuration['index_candidate_size']}] cannot be less than index size [{configuration['index_size']}]")
+
+    if configuration['primary_candidate_size'] > configuration['index_size']:
+        raise Exception(
+            f"Primary candidate size [{configuration['primary_candidate_size']}] cannot be greater than index size [{configuration['index_size']}]")
+
+    if configuration['secondary_candidate_size'] < configuration['primary_candidate_size']:
+        raise Exception(
+            f"Secondary candidate size [{configuration['secondary_candidate_size']}] cannot be greater than primary candidate size [{configuration['primary_candidate_size']}]")
+
+    if configuration['index_size'] * configuration['max_asset_allocation'] < 1:
+        raise Exception(
+            f"Max allocation [{configuration['max_asset_allocation']}] * index size [{configuration['index_size']}] cannot be less than 1.")
+
+    parse_cost_model(configuration.get('cost_model', 'flat'), configuration['fee'])
+
 
 class BCI(object):
     def __init__(self,
@@ -21,12 +173,20 @@ class BCI(object):
                  secondary_candidate_size: int,
                  initial_funds: float,
                  offset: int,
+                 cost_model: str = 'flat',
+                 deduct_fee: bool = False,
                  bypass_validation: bool = False,
                  input_file_name: str = None,
+                 resolution: str = None,
+                 market_data: MarketData = None,
+                 checkpoint_file_name: str = None,
                  start_dt: str = None,
                  end_dt: str = None,
                  show_graph: bool = False,
-                 save_graph: bool = False):
+                 save_graph: bool = False,
+                 trace: TraceWriter = None,
+                 selection_cache: SelectionCache = SELECTION_CACHE,
+                 timings: Timings = None):
         self.index_size = index_size
         self.rebalancing_period = rebalancing_period
         self.primary_usd_filtering = primary_usd_filtering
@@ -39,302 +199,482 @@ class BCI(object):
         self.secondary_candidate_size = secondary_candidate_size
         self.initial_funds = initial_funds
         self.offset = offset
+        self.cost_model = cost_model
+        self.deduct_fee = deduct_fee
+        self.costs: CostModel = parse_cost_model(cost_model, fee)
         self.bypass_validation = bypass_validation
         self.show_graph = show_graph
         self.save_graph = save_graph
+        self.trace = trace
+        self.selection_cache = selection_cache
+        self.timings = timings
         self.start_dt = start_dt
         self.end_dt = end_dt
 
-        self.portfolio: Dict = {}
-        self.orig_portfolio: Dict = {}
+        self.portfolio = Portfolio()
+        self.orig_portfolio = Portfolio()
         self.overall_fee: float = 0
 
-        self.data = None
+        # state of a simulation resumed from a checkpoint
+        self.checkpoint: Dict = None
+        self.last_date: str = None
+        self.days_elapsed: int = 0
+
+        self.data: MarketData = None
+        self.full_data: MarketData = None
         self.dates = None
-        self.data_by_coin = None
+        if checkpoint_file_name is not None:
+            self.load_checkpoint(checkpoint_file_name)
         if input_file_name is not None:
-            with open(input_file_name, 'r') as file:
-                self.set_input_data(json.loads(file.read()))
-
-        LOG.debug(f"\nConfiguration:\n"
-                  f"\tindex size: {index_size}\n"
-                  f"\trebalancing period: {rebalancing_period}\n"
-                  f"\tprimary USD filtering: {primary_usd_filtering}\n"
-                  f"\tsecondary USD filtering: {secondary_usd_filtering}\n"
-                  f"\tmaximal asset allocation: {max_asset_allocation}\n"
-                  f"\tfee: {fee}\n"
-                  f"\trunning average volume period: {running_avg_volume_period}\n"
-                  f"\tindex candidate size: {index_candidate_size}\n"
-                  f"\tprimary candidate size: {primary_candidate_size}\n"
-                  f"\tsecondary candidate size: {secondary_candidate_size}\n"
-                  f"\tinitial funds: {initial_funds}\n"
-                  f"\toffset: {offset}\n"
-                  f"\tbypass validation: {bypass_validation}\n"
-                  f"\tstart date: {start_dt}\n"
-                  f"\tend date: {end_dt}\n"
-                  f"\tinput filename: {input_file_name}")
+            started = self.timing_start()
+            market_data = MarketData.load(input_file_name, resolution)
+            self.timing_stop('load', started)
+        if market_data is not None:
+            started = self.timing_start()
+            self.set_input_data(market_data)
+            self.timing_stop('prepare', started)
+
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f"\nConfiguration:\n"
+                      f"\tindex size: {index_size}\n"
+                      f"\trebalancing period: {rebalancing_period}\n"
+                      f"\tprimary USD filtering: {primary_usd_filtering}\n"
+                      f"\tsecondary USD filtering: {secondary_usd_filtering}\n"
+                      f"\tmaximal asset allocation: {max_asset_allocation}\n"
+                      f"\tfee: {fee}\n"
+                      f"\trunning average volume period: {running_avg_volume_period}\n"
+                      f"\tindex candidate size: {index_candidate_size}\n"
+                      f"\tprimary candidate size: {primary_candidate_size}\n"
+                      f"\tsecondary candidate size: {secondary_candidate_size}\n"
+                      f"\tinitial funds: {initial_funds}\n"
+                      f"\toffset: {offset}\n"
+                      f"\tcost model: {cost_model}\n"
+                      f"\tdeduct fee: {deduct_fee}\n"
+                      f"\tbypass validation: {bypass_validation}\n"
+                      f"\tstart date: {start_dt}\n"
+                      f"\tend date: {end_dt}\n"
+                      f"\tinput filename: {input_file_name}\n"
+                      f"\tresolution: {resolution}\n"
+                      f"\tcheckpoint filename: {checkpoint_file_name}")
 
         if self.bypass_validation is False:
             self.validate()
 
     def validate(self):
-        if self.index_candidate_size < self.index_size:
-            raise Exception(f"Index candidate size [{self.index_candidate_size}] cannot be less than index size [{self.index_size}]")
-
-        if self.primary_candidate_size > self.index_size:
-            raise Exception(
-                f"Primary candidate size [{self.primary_candidate_size}] cannot be greater than index size [{self.index_size}]")
-
-        if self.secondary_candidate_size < self.primary_candidate_size:
-            raise Exception(
-                f"Secondary candidate size [{self.secondary_candidate_size}] cannot be greater than primary candidate size [{self.primary_candidate_size}]")
-
-        if self.index_size * self.max_asset_allocation < 1:
-            raise Exception(
-                f"Max allocation [{self.max_asset_allocation}] * index size [{self.index_size}] cannot be less than 1.")
+        validate_configuration(self.get_configuration())
 
+    # accepts either a MarketData instance or the raw input format {'date': {'coin1': {data1}, 'coin2': {...}}, ...}.
+    # Data prepared by PreparedMarketData are used as they are.
     def set_input_data(self, input_data):
-        self.data = dict(input_data)
-
-        self.dates = sorted(self.data.keys())
-
-        self.data_by_coin = {}
-        self.calc_data_by_coin()
+        if isinstance(input_data, MarketData) and input_data.prepared_for is not None and self.checkpoint is None:
+            if input_data.prepared_for != (self.start_dt, self.end_dt, self.running_avg_volume_period):
+                raise Exception(f"Data prepared for {input_data.prepared_for} cannot be used for simulation of "
+                                f"{(self.start_dt, self.end_dt, self.running_avg_volume_period)}")
+
+            self.data = input_data
+            self.full_data = input_data.source
+            self.dates = self.data.dates
+            return
+
+        if isinstance(input_data, MarketData):
+            self.data = input_data
+        else:
+            self.data = MarketData.from_dict(input_data)
+
+        # when resuming from a checkpoint, only dates following the last processed one are simulated and running
+        # average volume continues from the volume history stored in the checkpoint
+        history_size = 0
+        if self.checkpoint is not None:
+            history = self.checkpoint['volume_history']
+            history = MarketData(history['dates'],
+                                 history['coins'],
+                                 np.zeros((len(history['dates']), len(history['coins']))),
+                                 np.zeros((len(history['dates']), len(history['coins']))),
+                                 np.array(history['volume'], dtype = np.float64).reshape((len(history['dates']), len(history['coins']))))
+            self.data = self.data.rows(bisect.bisect_right(self.data.dates, self.last_date), len(self.data.dates)).with_history(history)
+            history_size = len(history.dates)
+
+            # portfolios are stored with coin names, coins are interned once the columns of the data are known
+            self.portfolio = Portfolio.from_dict(self.checkpoint['portfolio'], self.data.coin_index)
+            self.orig_portfolio = Portfolio.from_dict(self.checkpoint['orig_portfolio'], self.data.coin_index)
+
+        self.dates = self.data.dates
 
         self.calc_running_avg_volume()
 
-        self.prune_dates(self.start_dt, self.end_dt)
+        # keep the whole history for the sake of storing the running volume state into a checkpoint
+        self.full_data = self.data
+
+        if self.checkpoint is not None:
+            self.data = self.data.rows(history_size, len(self.data.dates))
+            self.prune_dates(None, self.end_dt)
+        else:
+            self.prune_dates(self.start_dt, self.end_dt)
 
     # remove dates outside the selected window
     def prune_dates(self, start_dt: str = None, end_dt: str = None):
-        for date in list(self.data.keys()):
-            if (start_dt is not None and date < start_dt) or (end_dt is not None and date > end_dt):
-                self.data.pop(date)
+        self.data = self.data.window(start_dt, end_dt)
+        self.dates = self.data.dates
 
-        self.data_by_coin = {coin: list(filter(lambda x: (start_dt is None or x[0] >= start_dt) and (end_dt is None or x[0] <= end_dt), data))
-                             for coin, data in self.data_by_coin.items()}
+    # enrich input with average volume over past X days
+    def calc_running_avg_volume(self):
+        self.data = self.data.with_running_avg_volume(self.running_avg_volume_period)
 
-        self.dates = list(filter(lambda x: (start_dt is None or x >= start_dt) and (end_dt is None or x <= end_dt), self.dates))
+    def run(self):
+        LOG.info(f"\nSimulation period: {self.dates[0]} - {self.dates[-1]}")
 
-    # transform input from {'date': {'coin1': {data1}, 'coin2': {...}}, ...} to {'coin1': [[date,data1],...], ...}
-    def calc_data_by_coin(self):
-        coins = set()
-        for _, v in self.data.items():
-            coins.update(v.keys())
+        # portfolio of a resumed simulation is restored from the checkpoint
+        if self.checkpoint is None:
+            started = self.timing_start()
+            self.init_portfolio(self.initial_funds)
+            self.timing_stop('init_portfolio', started)
+
+        # the portfolio stays unchanged between two rebalancing dates, hence its value is calculated for the whole
+        # segment at once
+        schedule = self.data.rebalance_schedule(self.rebalancing_period, self.days_elapsed, self.last_date)
+        value_index = np.empty(len(self.dates))
+        start = 0
+        for end in schedule + [len(self.dates)]:
+            started = self.timing_start()
+            value_index[start:end] = self.calc_portfolio_value(self.portfolio, start, end)
+            self.timing_stop('valuation', started)
+            if end < len(self.dates):
+                self.rebalance(end)
+            start = end
+        started = self.timing_start()
+        value_baseline = self.calc_portfolio_value(self.orig_portfolio, 0, len(self.dates))
+        self.timing_stop('valuation', started)
+
+        return self.complete_run(value_baseline, value_index, schedule)
+
+    # finalize the simulation once values of the baseline and index portfolio are calculated for all dates
+    def complete_run(self, value_baseline: np.ndarray, value_index: np.ndarray, schedule: List[int]) -> List:
+        self.last_date = self.dates[-1]
+        self.days_elapsed += len(self.dates)
+
+        value_baseline = value_baseline.tolist()
+        value_index = value_index.tolist()
+
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info(f"\nBaseline portfolio value: {value_baseline[-1]:,}")
+            LOG.info(f"Index portfolio value: {value_index[-1]:,}")
+            LOG.info(f"Fees: {self.overall_fee:,}")
 
-        for coin in coins:
-            self.data_by_coin[coin] = []
-            for date in self.dates:
-                if coin in self.data[date]:
-                    self.data_by_coin[coin].append([date, self.data[date][coin]])
-                else:
-                    self.data_by_coin[coin].append([date, {}])
+        if self.show_graph is True or self.save_graph is True:
+            started = self.timing_start()
+            graph_x_dates = [self.dates[i] for i in schedule if self.dates[i][8:10] == '01' and int(self.dates[i][5:7]) % 3 == 0]
+            self.plot_graph(value_baseline, value_index, graph_x_dates)
+            self.timing_stop('plot', started)
 
-    # enrich input with average volume over past X days
-    def calc_running_avg_volume(self):
-        for coin, data in self.data_by_coin.items():
-            volumes = [x[1]['volume'] if 'volume' in x[1] else 0 for x in data]
-            [sum(volumes[i - (self.running_avg_volume_period - 1):i + 1]) if i > (self.running_avg_volume_period - 1) else sum(volumes[:i + 1]) for i in range(len(volumes))]
+        return [self.dates, value_baseline, value_index, self.overall_fee]
 
-            for d, v in zip(data, volumes):
-                d[1]['volume_avg'] = v / self.running_avg_volume_period
+    # measure a phase of the simulation if timings are collected
+    def timing_start(self):
+        return self.timings.start() if self.timings is not None else None
+
+    def timing_stop(self, phase: str, started):
+        if self.timings is not None:
+            self.timings.stop(phase, started)
+
+    def get_configuration(self) -> Dict:
+        return {parameter: getattr(self, parameter) for parameter in CHECKPOINT_PARAMETERS}
+
+    # store state of the simulation after the last processed date so that it can be resumed with newly added dates
+    # only. Besides the portfolios, daily volumes needed to continue calculation of running average volume are stored.
+    def save_checkpoint(self, file_name: str):
+        end = bisect.bisect_right(self.full_data.dates, self.last_date)
+        history = self.full_data.rows(max(0, end - (self.running_avg_volume_period - 1)), end)
+        # coins held by the portfolios are stored even without volume (e.g. delisted ones) so that they are known
+        # when resuming with newly added dates only
+        cols = np.union1d(np.flatnonzero((history.volume != 0).any(axis = 0)), np.concatenate([self.portfolio.cols, self.orig_portfolio.cols]))
+
+        checkpoint = {
+            'configuration': self.get_configuration(),
+            'last_date': self.last_date,
+            'days_elapsed': self.days_elapsed,
+            'portfolio': self.portfolio.to_dict(self.data.coins),
+            'orig_portfolio': self.orig_portfolio.to_dict(self.data.coins),
+            'overall_fee': self.overall_fee,
+            'volume_history': {
+                'dates': history.dates,
+                'coins': [self.full_data.coins[col] for col in cols],
+                'volume': history.volume[:, cols].tolist()
+            }
+        }
+
+        with open(file_name, 'w') as file:
+            file.write(json.dumps(checkpoint))
+
+        LOG.info(f"Checkpoint stored into {file_name} (last date: {self.last_date})")
+
+    def load_checkpoint(self, file_name: str):
+        with open(file_name, 'r') as file:
+            checkpoint = json.loads(file.read())
+
+        for parameter, value in checkpoint['configuration'].items():
+            if getattr(self, parameter) != value:
+                raise Exception(f"Parameter {parameter} [{getattr(self, parameter)}] differs from the checkpoint [{value}]")
+
+        self.checkpoint = checkpoint
+        self.last_date = checkpoint['last_date']
+        self.days_elapsed = checkpoint['days_elapsed']
+        self.overall_fee = checkpoint['overall_fee']
+
+        LOG.info(f"Resuming simulation from {file_name} (last date: {self.last_date})")
+
+    def rebalance(self, i: int):
+        rebalance_started = self.timing_start()
+        date = self.dates[i]
+        coins = self.data.coins
+        # formatting of the (rather verbose) log messages is skipped unless they are going to be emitted
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        info = LOG.isEnabledFor(logging.INFO)
+        if info:
+            LOG.info(f"\nRebalancing {date}")
+
+        # selection depends only on the data of the date, the selection parameters and coins of the current
+        # portfolio, hence it is shared by simulations via the cache. The cache is bypassed when logging the
+        # selection details.
+        started = self.timing_start()
+        if self.selection_cache is not None and not info:
+            key = (self.data.token, self.data.first_row + i, tuple(self.portfolio.cols.tolist())) + tuple(getattr(self, parameter) for parameter in SELECTION_PARAMETERS)
+            selection = self.selection_cache.get(key)
+            cached = selection is not None
+            if not cached:
+                selection = tuple(map(tuple, self.select_coins(i, info, debug)))
+                self.selection_cache.put(key, selection)
+            (candidate_cols, final_cols) = selection
+
+            if self.timings is not None:
+                self.timings.count('selection_cache_hits' if cached else 'selection_cache_misses')
+        else:
+            (candidate_cols, final_cols) = self.select_coins(i, info, debug)
+        self.timing_stop('selection', started)
+
+        final_cols = np.array(final_cols, dtype = np.int32)
+        final_coins = [coins[col] for col in final_cols.tolist()] if info or self.trace is not None else None
+        if info:
+            LOG.info(f"\tIndex composition: {final_coins}")
+
+        price = self.data.price[i]
+
+        # calculate normalized percentage composition according to the capitalization
+        perc_allocation = self.calc_portfolio_percentage(final_cols, self.data.cap[i], self.max_asset_allocation)
+
+        if debug:
+            LOG.debug(f"\tCapped percentage allocation:")
+            LOG.debug("\n".join(f"\t\t{[coin, perc]}" for (coin, perc) in zip(final_coins, perc_allocation.tolist())))
+
+        # calculate USD value of the current portfolio and then distribute it into the new portfolio
+        # based on the calculated percentage
+        portfolio_sum = float(sum((self.portfolio.qty * price[self.portfolio.cols]).tolist()))
+
+        # coins of the new portfolio followed by coins being sold entirely, target weights and current holdings
+        sold = self.portfolio.cols[~np.isin(self.portfolio.cols, final_cols)]
+        cols = np.concatenate([final_cols, sold])
+        weights = np.concatenate([perc_allocation, np.zeros(len(sold))])
+        holdings = self.portfolio.quantities(cols)
+        coin_price = price[cols]
+        volume_usd = self.data.volume_avg[i][cols] * coin_price
+
+        # fee paid from the portfolio reduces the value distributed into the new portfolio which in turn reduces the
+        # fee, the value is iterated until it settles
+        value = portfolio_sum
+        for _ in range(FEE_DEDUCTION_ITERATIONS if self.deduct_fee is True else 1):
+            qty = np.divide(value * weights, coin_price, out = np.zeros(len(cols)), where = coin_price != 0)
+            trade = qty - holdings
+            trade_usd = trade * coin_price
+            fee = float(sum(self.costs.costs(trade_usd, volume_usd).tolist()))
+            if self.deduct_fee is False or abs(portfolio_sum - fee - value) <= FEE_DEDUCTION_TOLERANCE * portfolio_sum:
+                break
+            value = portfolio_sum - fee
 
-                if coin not in self.data[d[0]]:
-                    self.data[d[0]][coin] = {'cap': 0, 'price': 0, 'volume': 0}
-                self.data[d[0]][coin]['volume_avg'] = v / self.running_avg_volume_period
+        new_portfolio = Portfolio(final_cols, qty[:len(final_cols)])
 
-    def run(self):
-        LOG.info(f"\nSimulation period: {self.dates[0]} - {self.dates[-1]}")
+        if info:
+            LOG.info(f"\tNew portfolio allocation: {new_portfolio.to_dict(coins)}")
+            LOG.info(f"\tNew portfolio USD allocation: {dict(zip(final_coins, (qty * coin_price)[:len(final_cols)].tolist()))}")
+            LOG.info(f"\tPortfolio value: {portfolio_sum:,}")
 
-        self.init_portfolio(self.initial_funds)
-
-        value_baseline = []
-        value_index = []
-        graph_x_dates = []
-        for (i, date) in zip(range(len(self.dates)), self.dates):
-            # if rebalancing period is other than 0, then rebalance every (rebalancing period) days. Otherwise rebalance
-            # on the first day of month. Do not rebalance on the very first day since the result would be equal to the initialized portfolio
-            [year, month, day] = date.split('-')
-            if i != 0 and ((self.rebalancing_period > 0 and i % self.rebalancing_period == 0) or (self.rebalancing_period == 0 and day == '01')):
-                LOG.info(f"\nRebalancing {date}")
-                if day == '01' and int(month) % 3 == 0:
-                    graph_x_dates.append(date)
-
-                candidate_coins = []
-
-                # filter out existing portfolio coins with average daily volume less than self.primary_usd_filtering over the current month
-                LOG.debug(f"\tPrimary filtering:")
-                for coin in [key for key, _ in self.portfolio.items()]:
-                    LOG.debug(f"\t\t{coin}: value $: {self.data[date][coin]['volume_avg'] * self.data[date][coin]['price']:,} (average volume: {self.data[date][coin]['volume_avg']}, price: {self.data[date][coin]['price']})")
-                    if self.data[date][coin]['volume_avg'] * self.data[date][coin]['price'] > self.primary_usd_filtering:
-                        candidate_coins.append(coin)
-
-                LOG.debug(f"\t\tPreserved coins: {candidate_coins}")
-
-                # filter out all other coins with average daily volume less than self.secondary_usd_filtering over the current month
-                LOG.debug(f"\tSecondary filtering:")
-                ranking = sorted(self.data[date].items(), key = lambda x: x[1]['cap'], reverse = True)
-                for rank in ranking[self.offset:self.offset + self.index_candidate_size]:
-                    if rank[0] not in candidate_coins:
-                        LOG.debug(f"\t\t{rank[0]}: value $: {rank[1]['volume_avg'] * rank[1]['price']:,} (average volume: {rank[1]['volume_avg']}, price: {rank[1]['price']})")
-                        if rank[1]['volume_avg'] * rank[1]['price'] > self.secondary_usd_filtering:
-                            candidate_coins.append(rank[0])
-
-                    if len(candidate_coins) >= self.index_candidate_size:
-                        break
-
-                LOG.debug(f"\tCandidate list: {candidate_coins}")
-
-                # if filtering leads to having not enough coins, then add even the ones not meeting volume criteria
-                if len(candidate_coins) < self.index_candidate_size:
-                    candidate_coins += [rank[0] for rank in ranking[self.offset:self.offset + self.index_candidate_size]]
-                    candidate_coins = list(set(candidate_coins))
-                    LOG.info(f"\tNot enough candidates, adding additional ones despite not meeting volume criteria: {candidate_coins}")
-
-                # order all new candidates by their capitalization
-                candidate_coins = sorted(candidate_coins, key = lambda x: self.data[date][x]['cap'], reverse = True)
-                LOG.debug(f"\tSorted candidate list:")
-                LOG.debug("\n".join(map(lambda x: f"\t\t{x}:\t{self.data[date][x]['cap']:,}", candidate_coins)))
-
-                # add best X coins directly to the new portfolio
-                final_coins = candidate_coins[:self.primary_candidate_size]
-
-                # add next coins to the portfolio where coins in the current portfolio are prioritized even if having
-                # worse capitalization
-                for coin in candidate_coins[self.primary_candidate_size:self.secondary_candidate_size]:
-                    if coin in self.portfolio.keys() and len(final_coins) < self.index_size:
-                        final_coins.append(coin)
-
-                # add remaining coins to reach the index size
-                for coin in candidate_coins[:self.index_candidate_size]:
-                    if coin not in final_coins and len(final_coins) < self.index_size:
-                        final_coins.append(coin)
-                LOG.info(f"\tIndex composition: {final_coins}")
-
-                # calculate normalized percentage composition according to the capitalization
-                ranking = []
-                for coin in final_coins:
-                    ranking.append((coin, self.data[date][coin]))
-                perc_allocation = self.calc_portfolio_percentage(ranking, self.max_asset_allocation)
-
-                LOG.debug(f"\tCapped percentage allocation:")
-                LOG.debug("\n".join(map(lambda x: f"\t\t{x}", perc_allocation)))
-
-                # calculate USD value of the current portfolio and then distribute it into the new portfolio
-                # based on the calculated percentage
-                portfolio_sum = sum([qty * self.data[date][coin]['price'] for coin, qty in self.portfolio.items()])
-                new_portfolio = {coin[0]: (portfolio_sum * coin[1] / self.data[date][coin[0]]['price']) if self.data[date][coin[0]]['price'] != 0 else 0 for coin in perc_allocation}
-
-                LOG.info(f"\tNew portfolio allocation: {new_portfolio}")
-                new_portfolio_usd = {coin: qty * self.data[date][coin]['price'] for coin, qty in new_portfolio.items()}
-                LOG.info(f"\tNew portfolio USD allocation: {new_portfolio_usd}")
-                LOG.info(f"\tPortfolio value: {portfolio_sum:,}")
-
-                # for each coin in the old and new portfolio calculate the amount to be bought/sold
-                diff = {}
-                for coin, qty in new_portfolio.items():
-                    if coin in self.portfolio:
-                        diff[coin] = qty - self.portfolio[coin]
-                    else:
-                        diff[coin] = qty - 0
-                for coin, qty in self.portfolio.items():
-                    if coin not in new_portfolio:
-                        diff[coin] = 0 - self.portfolio[coin]
-
-                LOG.info(f"\tPortfolio updates: {diff}")
-
-                diff_usd = {coin: self.data[date][coin]['price'] * qty for coin, qty in diff.items()}
-                LOG.info(f"\tPortfolio USD updates: {diff_usd}")
-
-                # calculate fee for the bought/sold coins
-                diff_usd = {coin: abs(qty * self.data[date][coin]['price']) * self.fee for coin, qty in diff.items()}
-                fee = sum([usd for _, usd in diff_usd.items()])
-                self.overall_fee += fee
-                LOG.info(f"\tFee: {fee} USD")
-
-                self.portfolio = new_portfolio
-
-                # display value of the original portfolio with current prices
-                orig_portfolio_value = sum([qty * self.data[date][coin]['price'] for coin, qty in self.orig_portfolio.items()])
-                LOG.info(f"\tBaseline portfolio value: {orig_portfolio_value:,}")
+        # amounts of the coins bought/sold
+        diff = dict(zip([coins[col] for col in cols.tolist()], trade.tolist())) if info or self.trace is not None else None
+        if info:
+            LOG.info(f"\tPortfolio updates: {diff}")
+            LOG.info(f"\tPortfolio USD updates: {dict(zip(diff.keys(), trade_usd.tolist()))}")
 
-            value_baseline.append(sum([qty * self.data[date][coin]['price'] for coin, qty in self.orig_portfolio.items()]))
-            value_index.append(sum([qty * self.data[date][coin]['price'] for coin, qty in self.portfolio.items()]))
+        self.overall_fee += fee
+        if info:
+            LOG.info(f"\tFee: {fee} USD")
 
-        LOG.info(f"\nBaseline portfolio value: {value_baseline[-1]:,}")
-        LOG.info(f"Index portfolio value: {value_index[-1]:,}")
-        LOG.info(f"Fees: {self.overall_fee:,}")
+        self.portfolio = new_portfolio
 
-        if self.show_graph is True or self.save_graph is True:
-            self.plot_graph(value_baseline, value_index, graph_x_dates)
+        # display value of the original portfolio with current prices
+        if info or self.trace is not None:
+            orig_portfolio_value = sum((self.orig_portfolio.qty * price[self.orig_portfolio.cols]).tolist())
+            if info:
+                LOG.info(f"\tBaseline portfolio value: {orig_portfolio_value:,}")
 
-        return [self.dates, value_baseline, value_index, self.overall_fee]
+            if self.trace is not None:
+                self.trace.write(RebalanceRecord(date, [coins[col] for col in candidate_cols], final_coins,
+                                                 list(zip(final_coins, perc_allocation.tolist())), new_portfolio.to_dict(coins),
+                                                 portfolio_sum, diff, fee, float(orig_portfolio_value)))
+
+        if self.timings is not None:
+            self.timings.count('rebalances')
+            self.timings.stop('rebalance', rebalance_started)
+
+    # select index candidates ordered by capitalization and the new index composition on the i-th date, coins are
+    # given by their columns
+    def select_coins(self, i: int, info: bool = False, debug: bool = False) -> Tuple[List[int], List[int]]:
+        coins = self.data.coins
+
+        price = self.data.price[i]
+        cap = self.data.cap[i]
+        volume_avg = self.data.volume_avg[i]
+
+        # value $ of a coin logged when filtering
+        def log_value(col: int):
+            LOG.debug(f"\t\t{coins[col]}: value $: {volume_avg[col] * price[col]:,} (average volume: {volume_avg[col]}, price: {price[col]})")
+
+        # filter out existing portfolio coins with average daily volume less than self.primary_usd_filtering over the current month
+        held = self.portfolio.cols
+        candidate_cols = held[self.data.liquid_universe(i, self.primary_usd_filtering)[held]].tolist()
+
+        if debug:
+            LOG.debug(f"\tPrimary filtering:")
+            for col in held.tolist():
+                log_value(col)
+            LOG.debug(f"\t\tPreserved coins: {[coins[col] for col in candidate_cols]}")
+
+        # filter out all other coins with average daily volume less than self.secondary_usd_filtering over the current
+        # month. Coins of the cap ranking window are taken in order until there are enough candidates (at least one
+        # coin is examined even if there are enough already).
+        window = self.data.cap_ranking(i, self.offset + self.index_candidate_size)[self.offset:self.offset + self.index_candidate_size]
+        eligible = self.data.liquid_universe(i, self.secondary_usd_filtering)[window] & ~np.isin(window, candidate_cols)
+        needed = self.index_candidate_size - len(candidate_cols)
+        selected = np.flatnonzero(eligible)[:needed] if needed > 0 else np.flatnonzero(eligible[:1])
+
+        if debug:
+            LOG.debug(f"\tSecondary filtering:")
+            examined = selected[-1] + 1 if len(selected) == max(needed, 1) else (len(window) if needed > 0 else 1)
+            for col in window[:examined].tolist():
+                if col not in candidate_cols:
+                    log_value(col)
+
+        candidate_cols += window[selected].tolist()
+        ranking = window.tolist()
+
+        if debug:
+            LOG.debug(f"\tCandidate list: {[coins[col] for col in candidate_cols]}")
+
+        # if filtering leads to having not enough coins, then add even the ones not meeting volume criteria
+        if len(candidate_cols) < self.index_candidate_size:
+            candidate_cols = list(dict.fromkeys(candidate_cols + ranking))
+            if info:
+                LOG.info(f"\tNot enough candidates, adding additional ones despite not meeting volume criteria: {[coins[col] for col in candidate_cols]}")
+
+        # order all new candidates by their capitalization
+        candidate_cols = sorted(candidate_cols, key = lambda x: cap[x], reverse = True)
+        if debug:
+            LOG.debug(f"\tSorted candidate list:")
+            LOG.debug("\n".join(map(lambda x: f"\t\t{coins[x]}:\t{cap[x]:,}", candidate_cols)))
+
+        # add best X coins directly to the new portfolio
+        final_cols = candidate_cols[:self.primary_candidate_size]
+
+        # add next coins to the portfolio where coins in the current portfolio are prioritized even if having
+        # worse capitalization
+        held = set(held.tolist())
+        for col in candidate_cols[self.primary_candidate_size:self.secondary_candidate_size]:
+            if col in held and len(final_cols) < self.index_size:
+                final_cols.append(col)
+
+        # add remaining coins to reach the index size
+        for col in candidate_cols[:self.index_candidate_size]:
+            if col not in final_cols and len(final_cols) < self.index_size:
+                final_cols.append(col)
+
+        return candidate_cols, final_cols
+
+    # value of the portfolio for dates in [start, end)
+    def calc_portfolio_value(self, portfolio: 'Portfolio', start: int, end: int) -> np.ndarray:
+        cols = np.zeros((1, len(portfolio)), dtype = np.intp)
+        qty = np.zeros((1, len(portfolio)))
+        self.get_holdings(portfolio, cols[0], qty[0])
+
+        return calc_portfolio_values(self.data.price[start:end], cols, qty)[:, 0]
+
+    # store positions of the portfolio into a row of holdings, unused positions are left empty (zero quantity)
+    def get_holdings(self, portfolio: 'Portfolio', cols: np.ndarray, qty: np.ndarray):
+        cols[:] = 0
+        qty[:] = 0
+        cols[:len(portfolio)] = portfolio.cols
+        qty[:len(portfolio)] = portfolio.qty
 
     def init_portfolio(self, funds: float):
-        LOG.debug(f"\nInitializing portfolio for ${funds}...")
+        coins = self.data.coins
+        debug = LOG.isEnabledFor(logging.DEBUG)
+        if debug:
+            LOG.debug(f"\nInitializing portfolio for ${funds}...")
 
         # sort all currencies by their market capitalization and pick first N ones based on the index size (considering
         # optional offset)
-        ranking = sorted(self.data[self.dates[0]].items(), key = lambda x: x[1]['cap'], reverse = True)
-        ranking = ranking[self.offset:self.offset + self.index_size]
+        ranking = self.data.cap_ranking(0, self.offset + self.index_size)[self.offset:self.offset + self.index_size].astype(np.int32)
 
-        LOG.debug(f"\tTop {self.index_size} assets:")
-        LOG.debug("\n".join(map(lambda x: f"\t\t{x}", ranking)))
+        if debug:
+            LOG.debug(f"\tTop {self.index_size} assets:")
+            LOG.debug("\n".join(f"\t\t{(coins[col], self.data.record(0, col))}" for col in ranking.tolist()))
 
         # calculate percentage distribution according to the capitalization
-        perc_cap = self.calc_portfolio_percentage(ranking, self.max_asset_allocation)
+        perc_cap = self.calc_portfolio_percentage(ranking, self.data.cap[0], self.max_asset_allocation)
 
-        LOG.debug(f"\tCapped percentage allocation:")
-        LOG.debug("\n".join(map(lambda x: f"\t\t{x}", perc_cap)))
+        if debug:
+            LOG.debug(f"\tCapped percentage allocation:")
+            LOG.debug("\n".join(f"\t\t{[coins[col], perc]}" for (col, perc) in zip(ranking.tolist(), perc_cap.tolist())))
 
         # split funds among top coins according to the percentage distribution (ignore assets with 0 price)
-        self.portfolio = {coin[0]: (funds * coin[1] / self.data[self.dates[0]][coin[0]]['price']) if self.data[self.dates[0]][coin[0]]['price'] != 0 else 0 for coin in perc_cap}
-        LOG.info(f"Portfolio allocation: {self.portfolio}")
+        price = self.data.price[0][ranking]
+        self.portfolio = Portfolio(ranking, np.divide(funds * perc_cap, price, out = np.zeros(len(ranking)), where = price != 0))
+        if LOG.isEnabledFor(logging.INFO):
+            LOG.info(f"Portfolio allocation: {self.portfolio.to_dict(coins)}")
 
-        new_portfolio_usd = {coin: qty * self.data[self.dates[0]][coin]['price'] for coin, qty in self.portfolio.items()}
-        LOG.info(f"Portfolio USD allocation: {new_portfolio_usd}")
+            new_portfolio_usd = Portfolio(ranking, self.portfolio.qty * price).to_dict(coins)
+            LOG.info(f"Portfolio USD allocation: {new_portfolio_usd}")
 
         # store initial portfolio for sake of performance comparison later on
-        self.orig_portfolio = dict(self.portfolio)
+        self.orig_portfolio = self.portfolio.copy()
+
+        if self.trace is not None:
+            composition = [coins[col] for col in ranking.tolist()]
+            self.trace.write(RebalanceRecord(self.dates[0], composition, composition, list(zip(composition, perc_cap.tolist())),
+                                             self.portfolio.to_dict(coins), funds, self.portfolio.to_dict(coins), 0, funds))
 
-    def calc_portfolio_percentage(self, ranking, max_allocation):
+    # percentage allocation of coins in the given columns according to their capitalization
+    def calc_portfolio_percentage(self, cols: np.ndarray, cap: np.ndarray, max_allocation) -> np.ndarray:
         # normalize percentage allocation according to the capitalization
-        sum_cap = sum(coin[1]['cap'] for coin in ranking)
-        perc_cap = [[coin[0], coin[1]['cap'] / sum_cap] for coin in ranking]
+        cap = cap[cols]
+        sum_cap = sum(cap.tolist())
+        if len(cols) > 0 and sum_cap == 0:
+            raise Exception(f"Coins {[self.data.coins[col] for col in cols]} have no capitalization")
+        perc_cap = cap / sum_cap if len(cols) > 0 else cap
 
-        LOG.debug(f"\tPercentage allocation according to capitalization:")
-        LOG.debug("\n".join(map(lambda x: f"\t\t{x}", perc_cap)))
+        if LOG.isEnabledFor(logging.DEBUG):
+            LOG.debug(f"\tPercentage allocation according to capitalization:")
+            LOG.debug("\n".join(f"\t\t{[self.data.coins[col], perc]}" for (col, perc) in zip(cols.tolist(), perc_cap.tolist())))
 
         # cap percentage allocation at the selected maximum level
-        for i in range(len(perc_cap)):
-            if perc_cap[i][1] > max_allocation:
-                surplus = perc_cap[i][1] - max_allocation
-                perc_cap[i][1] = max_allocation
-
-                s = sum(coin[1] for coin in perc_cap[i + 1:])
-                perc_cap[i + 1:] = map(lambda x: [x[0], x[1] + surplus * (x[1] / s)], perc_cap[i + 1:])
-            else:
-                break
+        if len(perc_cap) > 0:
+            perc_cap = calc_capped_weights(perc_cap, max_allocation)
 
         return perc_cap
 
     def plot_graph(self, value_baseline, value_index, graph_x_dates):
-        plt.plot(self.dates, value_baseline, label = 'baseline', linewidth = 0.7)
-        plt.plot(self.dates, value_index, label = f'BCI{self.index_size}', linewidth = 0.7)
-
-        plt.xlabel('Date')
-        plt.xticks(graph_x_dates, rotation = 45, fontsize = 6)
-
-        plt.ylabel('Value (USD)')
-
-        plt.title(f'BCI{self.index_size} {self.dates[0]} - {self.dates[-1]}')
-
-        plt.grid(linestyle = '--', linewidth = 0.5)
-
-        plt.legend()
-
-        if self.save_graph is True:
-            plt.savefig(f"index{self.index_size}_{self.dates[0]}_{self.dates[-1]}.svg", format = "svg")
-
-        if self.show_graph is True:
-            plt.show()
\ No newline at end of file
+        # imported on demand so that simulations not drawing graphs do not load matplotlib
+        from Plot import plot_values
+
+        plot_values(self.dates,
+                    [('baseline', value_baseline), (f'BCI{self.index_size}', value_index)],
+                    f'BCI{self.index_size} {self.dates[0]} - {self.dates[-1]}',
+                    file_name = f"index{self.index_size}_{self.dates[0]}_{self.dates[-1]}.svg" if self.save_graph is True else None,
+                    show = self.show_graph,
+                    x_ticks = graph_x_dates)
@@ -0,0 +1,98 @@
+from typing import List, Tuple
+import logging
+
+import numpy as np
+
+from BCI import BCI, calc_portfolio_values
+from Instrumentation import Timings
+
+LOG = logging.getLogger(__name__)
+
+
+class BatchBCI(object):
+    # runs several BCI simulations sharing the same dates and rebalancing schedule in lockstep. Selection rules of each
+    # simulation are applied at the rebalancing dates, portfolios of all simulations are valued at once. Holdings are
+    # kept as (simulations x positions) matrices of coin columns and quantities where unused positions hold zero
+    # quantity, the values are therefore identical to those of independent BCI.run() calls.
+    def __init__(self, simulations: List[BCI], timings: Timings = None):
+        if len(simulations) == 0:
+            raise Exception("No simulations to run")
+
+        first = simulations[0]
+        for bci in simulations:
+            if bci.data is not first.data:
+                raise Exception("Simulations in a batch must share the same market data")
+            if bci.rebalancing_period != first.rebalancing_period or bci.days_elapsed != first.days_elapsed or bci.last_date != first.last_date:
+                raise Exception("Simulations in a batch must share the same rebalancing schedule")
+
+        self.simulations = simulations
+        self.data = first.data
+        self.timings = timings
+
+    # run all simulations. Results are returned in the order of simulations as tuples
+    # ([dates, baseline values, index values, fees], exception) where either the result or the exception is None.
+    # A simulation failing at a rebalancing date is dropped from the batch without affecting the others.
+    def run(self) -> List[Tuple[List, Exception]]:
+        n = len(self.data.dates)
+        if n == 0:
+            return [(None, Exception(f"No data between {bci.start_dt} and {bci.end_dt}")) for bci in self.simulations]
+
+        errors = [None] * len(self.simulations)
+
+        for (k, bci) in enumerate(self.simulations):
+            LOG.info(f"\nSimulation period: {self.data.dates[0]} - {self.data.dates[-1]}")
+            try:
+                if bci.checkpoint is None:
+                    started = bci.timing_start()
+                    bci.init_portfolio(bci.initial_funds)
+                    bci.timing_stop('init_portfolio', started)
+            except Exception as e:
+                errors[k] = e
+
+        size = max(max(bci.index_size, len(bci.portfolio), len(bci.orig_portfolio)) for bci in self.simulations)
+        cols = np.zeros((len(self.simulations), size), dtype = np.intp)
+        qty = np.zeros((len(self.simulations), size))
+
+        started = self.timings.start() if self.timings is not None else None
+        self.get_holdings(errors, cols, qty, baseline = True)
+        value_baseline = calc_portfolio_values(self.data.price, cols, qty)
+        if self.timings is not None:
+            self.timings.stop('valuation', started)
+
+        schedule = self.data.rebalance_schedule(self.simulations[0].rebalancing_period, self.simulations[0].days_elapsed, self.simulations[0].last_date)
+
+        value_index = np.empty((n, len(self.simulations)))
+        start = 0
+        for end in schedule + [n]:
+            started = self.timings.start() if self.timings is not None else None
+            self.get_holdings(errors, cols, qty)
+            value_index[start:end] = calc_portfolio_values(self.data.price[start:end], cols, qty)
+            if self.timings is not None:
+                self.timings.stop('valuation', started)
+
+            if end < n:
+                for (k, bci) in enumerate(self.simulations):
+                    if errors[k] is None:
+                        try:
+                            bci.rebalance(end)
+                        except Exception as e:
+                            errors[k] = e
+            start = end
+
+        results = []
+        for (k, bci) in enumerate(self.simulations):
+            if errors[k] is None:
+                results.append((bci.complete_run(value_baseline[:, k], value_index[:, k], schedule), None))
+            else:
+                results.append((None, errors[k]))
+
+        return results
+
+    # holdings of the index (or baseline) portfolios of all simulations, failed simulations hold nothing
+    def get_holdings(self, errors: List[Exception], cols: np.ndarray, qty: np.ndarray, baseline: bool = False):
+        for (k, bci) in enumerate(self.simulations):
+            if errors[k] is None:
+                bci.get_holdings(bci.orig_portfolio if baseline else bci.portfolio, cols[k], qty[k])
+            else:
+                cols[k] = 0
+                qty[k] = 0
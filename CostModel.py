@@ -0,0 +1,87 @@
+from typing import Dict, List, Tuple
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+# cost models are given by specifications which are plain strings, so that they can be part of sweep configurations,
+# checkpoints and stored results:
+#   flat                          fee rate of the configuration charged on the traded USD value
+#   tiered:<usd>:<rate>,...       fee rate of the highest tier (minimal traded USD value of a single trade) reached
+#   slippage:<impact>[:<exponent>] flat fee plus price impact impact * (traded USD / average daily USD volume) ^ exponent
+COST_MODELS = ['flat', 'tiered', 'slippage']
+
+# maximal cost rate of a single trade, e.g. for coins without volume
+MAX_COST_RATE = 1.0
+
+
+class CostModel(ABC):
+    # transaction costs of a rebalancing evaluated at once for all trades. trade_usd holds signed traded USD values,
+    # volume_usd average daily USD volumes of the traded coins.
+    @abstractmethod
+    def costs(self, trade_usd: np.ndarray, volume_usd: np.ndarray) -> np.ndarray:
+        pass
+
+
+class FlatFee(CostModel):
+    def __init__(self, rate: float):
+        self.rate = rate
+
+    def costs(self, trade_usd: np.ndarray, volume_usd: np.ndarray) -> np.ndarray:
+        return np.abs(trade_usd) * self.rate
+
+
+class TieredFee(CostModel):
+    # tiers (minimal traded USD value, fee rate), trades below the first tier are charged by its rate
+    def __init__(self, tiers: List[Tuple[float, float]]):
+        if len(tiers) == 0:
+            raise Exception("Tiered fee requires at least one tier")
+
+        tiers = sorted(tiers)
+        self.thresholds = np.array([threshold for (threshold, _) in tiers], dtype = np.float64)
+        self.rates = np.array([rate for (_, rate) in tiers], dtype = np.float64)
+
+    def costs(self, trade_usd: np.ndarray, volume_usd: np.ndarray) -> np.ndarray:
+        trade_usd = np.abs(trade_usd)
+        tiers = np.maximum(np.searchsorted(self.thresholds, trade_usd, side = 'right') - 1, 0)
+        return trade_usd * self.rates[tiers]
+
+
+class VolumeSlippage(CostModel):
+    # flat fee plus slippage growing with the share of the average daily volume traded (square root impact by default)
+    def __init__(self, rate: float, impact: float, exponent: float = 0.5):
+        self.rate = rate
+        self.impact = impact
+        self.exponent = exponent
+
+    def costs(self, trade_usd: np.ndarray, volume_usd: np.ndarray) -> np.ndarray:
+        trade_usd = np.abs(trade_usd)
+        participation = np.divide(trade_usd, volume_usd, out = np.full(trade_usd.shape, np.inf), where = volume_usd > 0)
+        participation[trade_usd == 0] = 0
+        return trade_usd * np.minimum(self.rate + self.impact * participation ** self.exponent, MAX_COST_RATE)
+
+
+_cost_models: Dict[Tuple[str, float], CostModel] = {}
+
+
+# cost model of a specification (see COST_MODELS), flat fee and slippage use the fee rate of the configuration
+def parse_cost_model(spec: str, fee: float) -> CostModel:
+    model = _cost_models.get((spec, fee))
+    if model is not None:
+        return model
+
+    (name, _, arguments) = spec.partition(':')
+    try:
+        if name == 'flat' and arguments == '':
+            model = FlatFee(fee)
+        elif name == 'tiered':
+            model = TieredFee([tuple(map(float, tier.split(':'))) for tier in arguments.split(',')])
+        elif name == 'slippage':
+            model = VolumeSlippage(fee, *map(float, arguments.split(':')))
+    except (TypeError, ValueError):
+        model = None
+
+    if model is None:
+        raise Exception(f"Invalid cost model [{spec}], use one of {COST_MODELS}")
+
+    _cost_models[(spec, fee)] = model
+    return model
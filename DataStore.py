@@ -0,0 +1,109 @@
+from typing import Dict, Iterable, Iterator, List, Set
+import heapq
+import json
+import os
+import tempfile
+
+# maximal number of files merged at once, more files are merged in several passes
+MERGE_FAN_IN = 256
+
+
+class DataStore(object):
+    # append-only on-disk store of downloaded market data. Each coin is stored in its own chunk file chunks/<coin>.jsonl
+    # holding one record {'date': ..., 'coin': ..., 'price': ..., 'cap': ..., 'volume': ...} per line ordered by date.
+    # Once a chunk is completely written, the coin is appended to the file with completed coins which serves as a resume
+    # marker for interrupted downloads.
+    def __init__(self, dir_name: str):
+        self.dir_name = dir_name
+        self.chunk_dir_name = os.path.join(dir_name, 'chunks')
+        self.completed_file_name = os.path.join(dir_name, 'completed')
+
+        os.makedirs(self.chunk_dir_name, exist_ok = True)
+
+    def completed_coins(self) -> Set[str]:
+        if not os.path.exists(self.completed_file_name):
+            return set()
+
+        with open(self.completed_file_name, 'r') as file:
+            return set(line.strip() for line in file if line.strip() != '')
+
+    def chunk_file_name(self, coin: str) -> str:
+        return os.path.join(self.chunk_dir_name, f"{coin.replace(os.sep, '_')}.jsonl")
+
+    # chunk files of all completed coins in the order of their (first) completion
+    def chunk_file_names(self) -> List[str]:
+        if not os.path.exists(self.completed_file_name):
+            return []
+
+        with open(self.completed_file_name, 'r') as file:
+            coins = dict.fromkeys(line.strip() for line in file if line.strip() != '')
+
+        return [self.chunk_file_name(coin) for coin in coins]
+
+    # write all records of a coin. Records are streamed into a temporary file which replaces the chunk only when
+    # complete, an interrupted write therefore leaves no partial chunk behind.
+    def write_coin(self, coin: str, records: Iterable[Dict]) -> int:
+        count = write_records(self.chunk_file_name(coin), records)
+
+        with open(self.completed_file_name, 'a') as file:
+            file.write(f"{coin}\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+        return count
+
+    # records of all completed coins ordered by date and coin
+    def records(self) -> Iterator[Dict]:
+        return merge_records(self.chunk_file_names())
+
+
+def read_records(file_name: str) -> Iterator[Dict]:
+    with open(file_name, 'r') as file:
+        for line in file:
+            if line.strip() != '':
+                yield json.loads(line)
+
+
+def write_records(file_name: str, records: Iterable[Dict]) -> int:
+    count = 0
+    with open(f"{file_name}.tmp", 'w') as file:
+        for record in records:
+            file.write(json.dumps(record))
+            file.write("\n")
+            count += 1
+
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(f"{file_name}.tmp", file_name)
+
+    return count
+
+
+def _keyed_records(file_name: str, i: int) -> Iterator:
+    for record in read_records(file_name):
+        yield (record['date'], record['coin'], i), record
+
+
+# external k-way merge of files with records ordered by (date, coin). If the same coin-day is present in several
+# files, the record from the file listed last wins.
+def merge_records(file_names: List[str]) -> Iterator[Dict]:
+    with tempfile.TemporaryDirectory() as tmp_dir_name:
+        # merge batches of files into intermediate runs until all remaining files can be opened at once. Batches
+        # consist of consecutive files, therefore the precedence of files is preserved.
+        run_count = 0
+        while len(file_names) > MERGE_FAN_IN:
+            runs = []
+            for i in range(0, len(file_names), MERGE_FAN_IN):
+                runs.append(os.path.join(tmp_dir_name, f"run_{run_count}.jsonl"))
+                write_records(runs[-1], merge_records(file_names[i:i + MERGE_FAN_IN]))
+                run_count += 1
+            file_names = runs
+
+        previous = None
+        for (key, record) in heapq.merge(*[_keyed_records(file_name, i) for (i, file_name) in enumerate(file_names)], key = lambda x: x[0]):
+            if previous is not None and previous[0][:2] != key[:2]:
+                yield previous[1]
+            previous = (key, record)
+
+        if previous is not None:
+            yield previous[1]
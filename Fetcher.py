@@ -0,0 +1,157 @@
+from typing import Any, Awaitable, Callable, Dict, Iterable, List
+from abc import ABC, abstractmethod
+import asyncio
+import random
+import time
+
+import aiohttp
+
+
+class HttpError(Exception):
+    def __init__(self, status: int, url: str, retry_after: float = None):
+        super().__init__(f"HTTP {status} for {url}")
+        self.status = status
+        self.url = url
+        self.retry_after = retry_after
+
+
+class HttpBackend(ABC):
+    # interface of the HTTP layer used by Fetcher, allows to replace the real HTTP client e.g. by a fake server
+    @abstractmethod
+    async def get_json(self, url: str, params: Dict = None) -> Any:
+        pass
+
+    async def close(self):
+        pass
+
+
+class AiohttpBackend(HttpBackend):
+    # single client session with a bounded connection pool, i.e. connections are reused across requests
+    def __init__(self, connections: int = 10, timeout: float = 60):
+        self.connections = connections
+        self.timeout = timeout
+        self.session: aiohttp.ClientSession = None
+
+    async def get_json(self, url: str, params: Dict = None) -> Any:
+        if self.session is None:
+            self.session = aiohttp.ClientSession(connector = aiohttp.TCPConnector(limit = self.connections),
+                                                 timeout = aiohttp.ClientTimeout(total = self.timeout))
+
+        params = {key: str(value) for key, value in params.items()} if params is not None else None
+        async with self.session.get(url, params = params) as response:
+            if response.status != 200:
+                retry_after = response.headers.get('Retry-After')
+                raise HttpError(response.status, url, float(retry_after) if retry_after is not None and retry_after.isdigit() else None)
+
+            return await response.json()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+class TokenBucket(object):
+    # rate limiter allowing [rate] requests per second on average with bursts of up to [capacity] requests
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FetchStats(object):
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.retries = 0
+        self.failed_requests = 0
+        self.jobs = 0
+        self.failed_jobs: List = []
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started
+        return (f"Fetched {self.jobs} jobs ({len(self.failed_jobs)} failed) in {elapsed:.1f}s: "
+                f"{self.requests} requests ({self.requests / elapsed if elapsed > 0 else 0:.2f} req/s), "
+                f"{self.retries} retries, {self.failed_requests} failed requests")
+
+
+class Fetcher(object):
+    # fetches JSON resources with bounded concurrency, rate limiting and retries with exponential backoff and jitter
+    def __init__(self,
+                 backend: HttpBackend,
+                 rate: float,
+                 concurrency: int,
+                 max_retries: int = 5,
+                 backoff_base: float = 1,
+                 backoff_max: float = 60):
+        self.backend = backend
+        self.rate_limiter = TokenBucket(rate, capacity = concurrency)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.stats = FetchStats()
+
+    async def get_json(self, url: str, params: Dict = None) -> Any:
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire()
+
+            self.stats.requests += 1
+            try:
+                return await self.backend.get_json(url, params)
+            except (HttpError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.stats.failed_requests += 1
+
+                # client errors other than "too many requests" would fail again
+                if attempt >= self.max_retries or (isinstance(e, HttpError) and 400 <= e.status < 500 and e.status != 429):
+                    raise e
+
+                # full jitter backoff, a delay requested by the server takes precedence
+                if isinstance(e, HttpError) and e.retry_after is not None:
+                    delay = e.retry_after
+                else:
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+                print(f"{e}, retrying after {delay:.1f}s")
+                self.stats.retries += 1
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    # process jobs by a pool of [concurrency] workers, results are passed to the handler in the order of completion.
+    # A failed job does not stop the others, failures are collected in stats.failed_jobs.
+    async def run(self, jobs: Iterable, fetch: Callable[[Any], Awaitable[Any]], handler: Callable[[Any, Any], None]):
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def worker():
+            while not queue.empty():
+                job = queue.get_nowait()
+                try:
+                    handler(job, await fetch(job))
+                    self.stats.jobs += 1
+                except Exception as e:
+                    print(f"{job} failed: {e}")
+                    self.stats.failed_jobs.append(job)
+
+        await asyncio.gather(*[worker() for _ in range(self.concurrency)])
+
+    async def close(self):
+        await self.backend.close()
@@ -0,0 +1,102 @@
+from typing import Dict, List, Tuple
+import os
+import sys
+import threading
+import time
+
+
+class Timings(object):
+    # accumulated wall clock and CPU time of named phases (phases may be nested, e.g. selection is a part of
+    # rebalance) and counters of events. Instrumented code checks for a Timings instance first, hence nothing is
+    # measured when it is not provided.
+    def __init__(self):
+        self.phases: Dict[str, List] = {}
+        self.counters: Dict[str, int] = {}
+
+    def start(self) -> Tuple[float, float]:
+        return time.perf_counter(), time.process_time()
+
+    def stop(self, phase: str, started: Tuple[float, float]):
+        wall = time.perf_counter() - started[0]
+        cpu = time.process_time() - started[1]
+
+        entry = self.phases.get(phase)
+        if entry is None:
+            entry = self.phases[phase] = [0, 0.0, 0.0]
+        entry[0] += 1
+        entry[1] += wall
+        entry[2] += cpu
+
+    def count(self, counter: str, n: int = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    # ratio of [name]_hits to all [name]_hits and [name]_misses counters
+    def hit_rate(self, name: str) -> float:
+        hits = self.counters.get(f"{name}_hits", 0)
+        misses = self.counters.get(f"{name}_misses", 0)
+        return hits / (hits + misses) if hits + misses > 0 else 0
+
+    def merge(self, other: 'Timings'):
+        for (phase, (calls, wall, cpu)) in other.phases.items():
+            entry = self.phases.get(phase)
+            if entry is None:
+                entry = self.phases[phase] = [0, 0.0, 0.0]
+            entry[0] += calls
+            entry[1] += wall
+            entry[2] += cpu
+
+        for (counter, n) in other.counters.items():
+            self.count(counter, n)
+
+    def report(self) -> str:
+        lines = [f"{'phase':<28}{'calls':>10}{'wall [s]':>12}{'cpu [s]':>12}"]
+        for (phase, (calls, wall, cpu)) in sorted(self.phases.items(), key = lambda x: x[1][1], reverse = True):
+            lines.append(f"{phase:<28}{calls:>10}{wall:>12.4f}{cpu:>12.4f}")
+
+        for (counter, n) in sorted(self.counters.items()):
+            lines.append(f"{counter:<28}{n:>10}")
+
+        for name in sorted(set(counter[:-len('_hits')] for counter in self.counters.keys() if counter.endswith('_hits'))):
+            lines.append(f"{name + ' hit rate':<28}{self.hit_rate(name) * 100:>9.1f}%")
+
+        return "\n".join(lines)
+
+
+class StackSampler(object):
+    # sampling profiler of a thread (the calling one by default). Stacks are sampled every [interval] seconds by a
+    # background thread and written in the collapsed format (frames separated by ';' followed by the number of
+    # samples) understood by flame graph tools.
+    def __init__(self, interval: float = 0.005, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks: Dict[str, int] = {}
+        self.stopped = threading.Event()
+        self.thread: threading.Thread = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target = self.sample, daemon = True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+
+            frames = []
+            while frame is not None:
+                frames.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_firstlineno})")
+                frame = frame.f_back
+
+            stack = ';'.join(reversed(frames))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+
+    def write(self, file_name: str):
+        with open(file_name, 'w') as file:
+            for (stack, samples) in sorted(self.stacks.items()):
+                file.write(f"{stack} {samples}\n")
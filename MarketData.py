@@ -0,0 +1,518 @@
+from typing import Dict, Iterable, List, Tuple
+from array import array
+from collections import OrderedDict
+import hashlib
+import itertools
+import json
+import os
+
+import numpy as np
+
+from DataStore import DataStore, read_records
+
+FIELDS = ['price', 'cap', 'volume', 'volume_avg']
+
+# fields persisted in the binary format, average volumes are always recalculated
+STORED_FIELDS = ['price', 'cap', 'volume']
+
+# minimal number of coins ranked by capitalization on a single date
+CAP_RANKING_SIZE = 64
+
+# source of unique tokens of market data
+_tokens = itertools.count()
+
+
+# int32 day ordinals (days since 1970-01-01) of dates in YYYY-MM-DD format, a time of day following the date is ignored
+def day_ordinals(dates: List[str]) -> np.ndarray:
+    return np.array([date[:10] for date in dates], dtype = 'datetime64[D]').astype(np.int32)
+
+
+# listing intervals [first, end) of coins given by rows and columns of their observations, coins never observed
+# get an empty interval
+def calc_listing(rows: np.ndarray, cols: np.ndarray, coins: int) -> Tuple[np.ndarray, np.ndarray]:
+    first = np.full(coins, np.iinfo(np.int64).max, dtype = np.int64)
+    end = np.zeros(coins, dtype = np.int64)
+    np.minimum.at(first, cols, rows)
+    np.maximum.at(end, cols, rows + 1)
+    first[end == 0] = 0
+
+    return (first, end)
+
+
+class MarketData(object):
+    # columnar store of the market history, every field is a dense (date x coin) matrix where a row is addressed via
+    # date_index and a column via coin_index. Coin-days missing in the input are represented by zeros.
+    #
+    # Coins and dates are interned: the column of a coin serves as its numeric ID (kept by all views of the data) and
+    # dates are compared via their day ordinals. Strings are needed only when presenting results.
+    #
+    # Listing intervals of the coins are collected while building the store from observations, so that dates are
+    # ranked and filtered only among the coins listed on them.
+    def __init__(self,
+                 dates: List[str],
+                 coins: List[str],
+                 price: np.ndarray,
+                 cap: np.ndarray,
+                 volume: np.ndarray,
+                 volume_avg: np.ndarray = None,
+                 coin_index: Dict[str, int] = None,
+                 running_avg_volumes: Dict[int, np.ndarray] = None,
+                 cap_rankings: Dict[int, np.ndarray] = None,
+                 liquid_universes: Dict[Tuple, np.ndarray] = None,
+                 token = None,
+                 listing: Tuple[np.ndarray, np.ndarray] = None,
+                 days: np.ndarray = None,
+                 first_row: int = 0):
+        self.dates = dates
+        self.days = days if days is not None else day_ordinals(dates)
+        self.coins = coins
+        self.price = price
+        self.cap = cap
+        self.volume = volume
+        self.volume_avg = volume_avg if volume_avg is not None else np.zeros(volume.shape)
+
+        self.date_index = {date: i for (i, date) in enumerate(dates)}
+        self.coin_index = coin_index if coin_index is not None else {coin: i for (i, coin) in enumerate(coins)}
+
+        # running average volumes already calculated for this set of dates, keyed by the period
+        self.running_avg_volumes = running_avg_volumes if running_avg_volumes is not None else {}
+
+        # coins ordered by capitalization (best first), keyed by the row of the data the views are derived from
+        # (first_row + row). Rankings depend only on the capitalization of a given date, hence they are shared by all
+        # views derived from the same data.
+        self.cap_rankings = cap_rankings if cap_rankings is not None else {}
+        self.first_row = first_row
+
+        # masks of coins with average USD volume above a threshold, keyed by (token, first_row + row, threshold). The
+        # masks depend on average volumes, hence they are shared by views with the same token only.
+        self.liquid_universes = liquid_universes if liquid_universes is not None else {}
+
+        # indices of rebalancing dates, keyed by the rebalancing period and number of days elapsed before
+        self.rebalance_schedules: Dict[Tuple[int, int, str], List[int]] = {}
+
+        # identifies values of the data, views holding the same values for a date (e.g. windows) share the token.
+        # Results derived from the data of a given date can be therefore cached across views under
+        # (token, first_row + row).
+        self.token = token if token is not None else next(_tokens)
+
+        # rows [first, end) of every coin between its first and last observation, calculated on demand
+        self.listing = listing
+        self.listing_order: Tuple[np.ndarray, np.ndarray] = None
+
+        # (start date, end date, running average volume period) of data prepared by PreparedMarketData and data
+        # the view was derived from
+        self.prepared_for: Tuple = None
+        self.source: MarketData = None
+
+    # build the store from the input format {'date': {'coin1': {data1}, 'coin2': {...}}, ...}
+    @classmethod
+    def from_dict(cls, input_data: Dict) -> 'MarketData':
+        dates = sorted(input_data.keys())
+
+        coin_index = {}
+        for date in dates:
+            for coin in input_data[date].keys():
+                if coin not in coin_index:
+                    coin_index[coin] = len(coin_index)
+
+        arrays = {field: np.zeros((len(dates), len(coin_index))) for field in FIELDS}
+        rows = array('q')
+        cols = array('q')
+        for (i, date) in enumerate(dates):
+            for coin, values in input_data[date].items():
+                j = coin_index[coin]
+                for field in FIELDS:
+                    arrays[field][i, j] = values.get(field) or 0
+                if any(arrays[field][i, j] != 0 for field in STORED_FIELDS):
+                    rows.append(i)
+                    cols.append(j)
+
+        listing = calc_listing(np.frombuffer(rows, dtype = np.int64), np.frombuffer(cols, dtype = np.int64), len(coin_index))
+
+        return cls(dates, list(coin_index.keys()), coin_index = coin_index, listing = listing, **arrays)
+
+    # build the store from a stream of coin-day records {'date': ..., 'coin': ..., 'price': ..., 'cap': ..., 'volume': ...}
+    # (see DataStore). Values are collected into flat arrays, no per-record objects are kept.
+    @classmethod
+    def from_records(cls, records: Iterable[Dict]) -> 'MarketData':
+        date_index = {}
+        coin_index = {}
+        rows = array('q')
+        cols = array('q')
+        values = {field: array('d') for field in STORED_FIELDS}
+        for record in records:
+            rows.append(date_index.setdefault(record['date'], len(date_index)))
+            cols.append(coin_index.setdefault(record['coin'], len(coin_index)))
+            for field in STORED_FIELDS:
+                values[field].append(record.get(field) or 0)
+
+        # map rows in the order of appearance to rows ordered by date
+        dates = sorted(date_index.keys())
+        sorted_rows = np.empty(len(dates), dtype = np.int64)
+        sorted_rows[[date_index[date] for date in dates]] = np.arange(len(dates))
+        rows = sorted_rows[np.frombuffer(rows, dtype = np.int64)]
+        cols = np.frombuffer(cols, dtype = np.int64)
+
+        arrays = {}
+        for field in STORED_FIELDS:
+            arrays[field] = np.zeros((len(dates), len(coin_index)))
+            arrays[field][rows, cols] = np.frombuffer(values[field], dtype = np.float64)
+
+        # coin-days stored more than once keep their last record, observations are therefore read from the arrays
+        observed = np.zeros(len(rows), dtype = bool)
+        for field in STORED_FIELDS:
+            observed |= arrays[field][rows, cols] != 0
+        listing = calc_listing(rows[observed], cols[observed], len(coin_index))
+
+        return cls(dates, list(coin_index.keys()), coin_index = coin_index, listing = listing, **arrays)
+
+    # load input data. A directory is read as DataStore, files with the .jsonl extension as a stream of records (e.g.
+    # merged DataStore) and other files as JSON in the input format. For files, a binary copy is kept in the directory
+    # <input file name>.cache and memory mapped on subsequent loads as long as the input file has not changed.
+    # If resolution is given, the directory is read as SampleStore of timestamped samples resampled to the resolution.
+    @classmethod
+    def load(cls, input_file_name: str, resolution: str = None) -> 'MarketData':
+        if resolution is not None:
+            from SampleStore import SampleStore
+            return SampleStore.load(input_file_name).resample(resolution)
+
+        if os.path.isdir(input_file_name):
+            return cls.from_records(DataStore(input_file_name).records())
+
+        cache_dir = f"{input_file_name}.cache"
+        index_file_name = os.path.join(cache_dir, 'index.json')
+        stat = os.stat(input_file_name)
+
+        if os.path.exists(index_file_name):
+            with open(index_file_name, 'r') as file:
+                index = json.loads(file.read())
+
+            # file modification time may change without content being changed (e.g. after copying), fall back to the
+            # hash comparison in such case
+            source = index['source']
+            if source['size'] == stat.st_size and source['mtime'] == stat.st_mtime_ns:
+                return cls.open(cache_dir)
+            elif source['size'] == stat.st_size and source['sha256'] == file_hash(input_file_name):
+                source['mtime'] = stat.st_mtime_ns
+                write_json(index_file_name, index)
+                return cls.open(cache_dir)
+
+        if input_file_name.endswith('.jsonl'):
+            market_data = cls.from_records(read_records(input_file_name))
+        else:
+            with open(input_file_name, 'r') as file:
+                market_data = cls.from_dict(json.loads(file.read()))
+
+        market_data.save(cache_dir, {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': file_hash(input_file_name)})
+
+        return cls.open(cache_dir)
+
+    # store the data in a binary format, one raw .npy file per field and listing intervals and an index file with
+    # dates, coins and optional description of the source the data were created from. Index file is written last, therefore its
+    # presence marks a complete store.
+    def save(self, dir_name: str, source: Dict = None):
+        os.makedirs(dir_name, exist_ok = True)
+
+        index_file_name = os.path.join(dir_name, 'index.json')
+        if os.path.exists(index_file_name):
+            os.remove(index_file_name)
+
+        # replace the files rather than overwriting them since they may be memory mapped by other processes
+        for field in STORED_FIELDS:
+            np.save(os.path.join(dir_name, f"{field}.tmp.npy"), np.ascontiguousarray(getattr(self, field)))
+            os.replace(os.path.join(dir_name, f"{field}.tmp.npy"), os.path.join(dir_name, f"{field}.npy"))
+
+        np.save(os.path.join(dir_name, 'listing.tmp.npy'), np.stack(self.listing_intervals()))
+        os.replace(os.path.join(dir_name, 'listing.tmp.npy'), os.path.join(dir_name, 'listing.npy'))
+
+        write_json(index_file_name, {'source': source, 'dates': self.dates, 'coins': self.coins})
+
+    # open data stored by save(), arrays are memory mapped read-only and therefore shared by all processes using
+    # the same store. Listing intervals missing in stores written by older versions are calculated on demand.
+    @classmethod
+    def open(cls, dir_name: str) -> 'MarketData':
+        with open(os.path.join(dir_name, 'index.json'), 'r') as file:
+            index = json.loads(file.read())
+
+        arrays = {field: np.load(os.path.join(dir_name, f"{field}.npy"), mmap_mode = 'r') for field in STORED_FIELDS}
+
+        listing_file_name = os.path.join(dir_name, 'listing.npy')
+        listing = tuple(np.load(listing_file_name)) if os.path.exists(listing_file_name) else None
+
+        return cls(index['dates'], index['coins'], listing = listing, **arrays)
+
+    # export view in the input format, only coins with at least one non-zero value on a given date are listed
+    def to_dict(self) -> Dict:
+        output = {}
+        for (i, date) in enumerate(self.dates):
+            output[date] = {}
+            for j in np.flatnonzero((self.price[i] != 0) | (self.cap[i] != 0) | (self.volume[i] != 0)):
+                output[date][self.coins[j]] = self.record(i, j)
+
+        return output
+
+    def record(self, row: int, col: int) -> Dict:
+        return {field: getattr(self, field)[row, col].item() for field in FIELDS}
+
+    # calculate running average volume over the past X days for all coins and all requested periods in a single pass
+    # over the cumulative volume. The sum is always divided by the full period, i.e. the first days of the history
+    # (fewer than period days available) average the missing days as zero volume.
+    def calc_running_avg_volume(self, periods: List[int]) -> Dict[int, np.ndarray]:
+        periods = [period for period in set(periods) if period not in self.running_avg_volumes]
+        if len(periods) > 0:
+            cum_volume = np.cumsum(self.volume, axis = 0)
+
+            for period in periods:
+                window_volume = cum_volume.copy()
+                window_volume[period:] -= cum_volume[:-period]
+
+                # cumulative sums may leave tiny negative residues for coins whose volume dropped to zero
+                np.maximum(window_volume, 0, out = window_volume)
+                self.running_avg_volumes[period] = window_volume / period
+
+        return self.running_avg_volumes
+
+    # return columns of (at least) the top [size] coins on a given date ordered by capitalization, coins with equal
+    # capitalization keep their column order
+    def cap_ranking(self, row: int, size: int) -> np.ndarray:
+        ranking = self.cap_rankings.get(self.first_row + row)
+        if ranking is None or len(ranking) < min(size, len(self.coins)):
+            self.calc_cap_rankings([row], size)
+            ranking = self.cap_rankings[self.first_row + row]
+
+        return ranking
+
+    # rank coins on the given dates. Only the top of the ranking is sorted, its size is rounded up so that
+    # rankings can be reused by configurations with slightly different offsets or candidate sizes.
+    def calc_cap_rankings(self, rows: List[int], size: int):
+        size = min(max(CAP_RANKING_SIZE, 1 << (size - 1).bit_length()), len(self.coins))
+
+        for row in rows:
+            ranking = self.cap_rankings.get(self.first_row + row)
+            if ranking is not None and len(ranking) >= size:
+                continue
+
+            key = -self.cap[row]
+            if size == len(key):
+                self.cap_rankings[self.first_row + row] = np.argsort(key, kind = 'stable').astype(np.int32)
+                continue
+
+            # rank only coins listed on the date. Coins not listed have zero capitalization, the result is therefore
+            # the same as long as the top coins have non-zero capitalization.
+            listed = self.listed_columns(row)
+            if len(listed) >= size:
+                listed_key = key[listed]
+                last = np.partition(listed_key, size - 1)[size - 1]
+                if last < 0:
+                    better = listed[listed_key < last]
+                    top = np.concatenate([better, listed[listed_key == last][:size - len(better)]])
+                    self.cap_rankings[self.first_row + row] = top[np.argsort(key[top], kind = 'stable')].astype(np.int32)
+                    continue
+
+            # select the top coins via partitioning, coins equal to the last selected one are taken in column order
+            last = np.partition(key, size - 1)[size - 1]
+            better = np.flatnonzero(key < last)
+            top = np.concatenate([better, np.flatnonzero(key == last)[:size - len(better)]])
+            self.cap_rankings[self.first_row + row] = top[np.argsort(key[top], kind = 'stable')].astype(np.int32)
+
+    # mask of coins whose average USD volume (volume_avg * price) exceeds the threshold on a given date. Coins not
+    # traded on the date have zero price, i.e. the universe holds only coins existing on the date.
+    def liquid_universe(self, row: int, threshold: float) -> np.ndarray:
+        universe = self.liquid_universes.get((self.token, self.first_row + row, threshold))
+        if universe is None:
+            self.calc_liquid_universes([row], [threshold])
+            universe = self.liquid_universes[(self.token, self.first_row + row, threshold)]
+
+        return universe
+
+    # calculate liquid universes of all thresholds on the given dates, USD volumes of a date are calculated only once
+    def calc_liquid_universes(self, rows: List[int], thresholds: Iterable[float]):
+        thresholds = list(thresholds)
+        for row in rows:
+            usd_volume = None
+            for threshold in thresholds:
+                key = (self.token, self.first_row + row, threshold)
+                if key in self.liquid_universes:
+                    continue
+
+                # coins not listed on the date have zero price, only the listed ones are therefore examined
+                if usd_volume is None:
+                    listed = self.listed_columns(row)
+                    usd_volume = self.volume_avg[row, listed] * self.price[row, listed]
+                universe = np.zeros(len(self.coins), dtype = bool)
+                universe[listed[usd_volume > threshold]] = True
+                self.liquid_universes[key] = universe
+
+    # rows [first, end) of every coin between its first and last observation (price, capitalization or volume),
+    # a coin is not listed outside of its interval. Coins never observed have an empty interval. Intervals are
+    # collected when loading the data, the matrices are scanned only for data given by arrays without them.
+    def listing_intervals(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.listing is None:
+            observed = (self.price != 0) | (self.cap != 0) | (self.volume != 0)
+            ever_observed = observed.any(axis = 0)
+            first = np.where(ever_observed, observed.argmax(axis = 0), 0)
+            end = np.where(ever_observed, len(self.dates) - observed[::-1].argmax(axis = 0), 0)
+            self.listing = (first, end)
+
+        return self.listing
+
+    # columns of coins listed on a given date in ascending order. Only coins listed until the date are examined.
+    def listed_columns(self, row: int) -> np.ndarray:
+        (first, end) = self.listing_intervals()
+        if self.listing_order is None:
+            order = np.argsort(first, kind = 'stable')
+            self.listing_order = (order, first[order])
+
+        (order, sorted_first) = self.listing_order
+        columns = order[:np.searchsorted(sorted_first, row, side = 'right')]
+        return np.sort(columns[end[columns] > row])
+
+    # indices of dates when the portfolio gets rebalanced. If rebalancing period is other than 0, then rebalance every
+    # (rebalancing period) days (rows of resampled data). Otherwise rebalance on the first date of month. The first day of the simulation is
+    # never included since the result would be equal to the initialized portfolio. Days elapsed denotes the number
+    # of days simulated before the first date and last date the last date simulated (when resuming a simulation).
+    def rebalance_schedule(self, rebalancing_period: int, days_elapsed: int = 0, last_date: str = None) -> List[int]:
+        key = (rebalancing_period, days_elapsed, last_date)
+        if key not in self.rebalance_schedules:
+            if rebalancing_period > 0:
+                first = (-days_elapsed) % rebalancing_period if days_elapsed > 0 else rebalancing_period
+                schedule = list(range(first, len(self.dates), rebalancing_period))
+            else:
+                months = self.days.astype('datetime64[D]').astype('datetime64[M]')
+                schedule = (np.flatnonzero(months[1:] != months[:-1]) + 1).tolist()
+                # a resumed simulation rebalances on its first date if a new month started since the last date
+                # simulated, even if the first date of the month is missing
+                if len(self.dates) > 0 and last_date is not None and self.dates[0][:7] != last_date[:7]:
+                    schedule.insert(0, 0)
+
+            self.rebalance_schedules[key] = schedule
+
+        return self.rebalance_schedules[key]
+
+    # return a view where volume_avg holds running average volume over the given period
+    def with_running_avg_volume(self, period: int) -> 'MarketData':
+        self.calc_running_avg_volume([period])
+
+        # average volumes depend on the first row the average starts from, views of the same data starting at
+        # different rows therefore get different tokens
+
+        return MarketData(self.dates,
+                          self.coins,
+                          self.price,
+                          self.cap,
+                          self.volume,
+                          self.running_avg_volumes[period],
+                          coin_index = self.coin_index,
+                          running_avg_volumes = self.running_avg_volumes,
+                          cap_rankings = self.cap_rankings,
+                          liquid_universes = self.liquid_universes,
+                          token = (self.token, period, self.first_row),
+                          listing = self.listing,
+                          days = self.days,
+                          first_row = self.first_row)
+
+    # return a view restricted to days within [start_dt, end_dt], underlying arrays are not copied
+    def window(self, start_dt: str = None, end_dt: str = None) -> 'MarketData':
+        start = int(np.searchsorted(self.days, day_ordinals([start_dt])[0], side = 'left')) if start_dt is not None else 0
+        end = int(np.searchsorted(self.days, day_ordinals([end_dt])[0], side = 'right')) if end_dt is not None else len(self.dates)
+
+        return self.rows(start, end)
+
+    # return a view restricted to rows [start, end), underlying arrays are not copied
+    def rows(self, start: int, end: int) -> 'MarketData':
+        return MarketData(self.dates[start:end],
+                          self.coins,
+                          self.price[start:end],
+                          self.cap[start:end],
+                          self.volume[start:end],
+                          self.volume_avg[start:end],
+                          coin_index = self.coin_index,
+                          cap_rankings = self.cap_rankings,
+                          liquid_universes = self.liquid_universes,
+                          token = self.token,
+                          listing = tuple(np.clip(rows - start, 0, end - start) for rows in self.listing) if self.listing is not None else None,
+                          days = self.days[start:end],
+                          first_row = self.first_row + start)
+
+    # return a copy with rows of the (preceding) history prepended. Columns of this instance keep their position,
+    # coins present only in the history are appended.
+    def with_history(self, history: 'MarketData') -> 'MarketData':
+        if len(history.dates) > 0 and len(self.dates) > 0 and history.dates[-1] >= self.dates[0]:
+            raise Exception(f"History [{history.dates[0]} - {history.dates[-1]}] overlaps data starting at {self.dates[0]}")
+
+        coins = self.coins + [coin for coin in history.coins if coin not in self.coin_index]
+        coin_index = {coin: i for (i, coin) in enumerate(coins)}
+        history_cols = [coin_index[coin] for coin in history.coins]
+
+        arrays = {}
+        for field in STORED_FIELDS:
+            arrays[field] = np.zeros((len(history.dates) + len(self.dates), len(coins)))
+            arrays[field][:len(history.dates), history_cols] = getattr(history, field)
+            arrays[field][len(history.dates):, :len(self.coins)] = getattr(self, field)
+
+        # coins listed in the history start there, coins listed in this instance end here
+        first = np.zeros(len(coins), dtype = np.int64)
+        end = np.zeros(len(coins), dtype = np.int64)
+        (data_first, data_end) = self.listing_intervals()
+        cols = np.flatnonzero(data_end > 0)
+        first[cols] = data_first[cols] + len(history.dates)
+        end[cols] = data_end[cols] + len(history.dates)
+
+        (history_first, history_end) = history.listing_intervals()
+        observed = np.flatnonzero(history_end > 0)
+        cols = np.asarray(history_cols, dtype = np.int64)[observed]
+        end[cols] = np.where(end[cols] > 0, end[cols], history_end[observed])
+        first[cols] = history_first[observed]
+
+        return MarketData(history.dates + self.dates, coins, coin_index = coin_index, days = np.concatenate([history.days, self.days]), listing = (first, end), **arrays)
+
+
+class PreparedMarketData(object):
+    # factory of market data prepared for a simulation, i.e. restricted to a date window with average volume over
+    # a given period. Prepared views are read-only, share arrays with the source data and are memoized with LRU
+    # eviction so that simulations with equal window and period share one view.
+    def __init__(self, market_data: MarketData, max_size: int = 16):
+        self.market_data = market_data
+        self.max_size = max_size
+        self.views: OrderedDict = OrderedDict()
+
+    def get(self, start_dt: str = None, end_dt: str = None, running_avg_volume_period: int = 30) -> MarketData:
+        key = (start_dt, end_dt, running_avg_volume_period)
+        if key in self.views:
+            self.views.move_to_end(key)
+            return self.views[key]
+
+        # listing intervals are calculated once for the source data and shifted for the views
+        self.market_data.listing_intervals()
+        source = self.market_data.with_running_avg_volume(running_avg_volume_period)
+        view = source.window(start_dt, end_dt)
+        for field in FIELDS:
+            getattr(view, field).flags.writeable = False
+        view.prepared_for = key
+        view.source = source
+
+        self.views[key] = view
+        if len(self.views) > self.max_size:
+            (_, _, period) = self.views.popitem(last = False)[0]
+
+            # release average volumes not used by any of the remaining views
+            if all(key[2] != period for key in self.views.keys()):
+                self.market_data.running_avg_volumes.pop(period, None)
+
+        return view
+
+
+def file_hash(file_name: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+# write JSON file atomically so that concurrent readers never see a partially written file
+def write_json(file_name: str, data):
+    with open(f"{file_name}.tmp", 'w') as file:
+        file.write(json.dumps(data))
+    os.replace(f"{file_name}.tmp", file_name)
@@ -0,0 +1,62 @@
+from typing import Dict, List, Tuple
+import sys
+
+# plotting helpers, matplotlib is imported only once a graph is actually drawn. Graphs which are only saved are
+# rendered by the non-interactive Agg backend, i.e. no GUI toolkit gets loaded.
+
+
+def pyplot(interactive: bool = False):
+    if interactive is False and 'matplotlib.pyplot' not in sys.modules:
+        import matplotlib
+        matplotlib.use('Agg')
+
+    import matplotlib.pyplot as plt
+    return plt
+
+
+# dates on the first day of every quarter used as ticks of the date axis
+def quarter_ticks(dates: List[str]) -> List[str]:
+    return [date for date in dates if date[8:10] == '01' and int(date[5:7]) % 3 == 0]
+
+
+# plot value series of several configurations over the same dates, the graph is stored into a file and/or shown
+def plot_values(dates: List[str],
+                series: List[Tuple[str, List[float]]],
+                title: str,
+                file_name: str = None,
+                show: bool = False,
+                x_ticks: List[str] = None,
+                linewidth: float = 0.7,
+                legend: Dict = None):
+    plt = pyplot(interactive = show)
+
+    for (label, values) in series:
+        plt.plot(dates, values, label = label, linewidth = linewidth)
+
+    plt.xlabel('Date')
+    plt.xticks(x_ticks if x_ticks is not None else quarter_ticks(dates), rotation = 45, fontsize = 6)
+
+    plt.ylabel('Value (USD)')
+
+    plt.title(title)
+
+    plt.grid(linestyle = '--', linewidth = 0.5)
+
+    plt.legend(**(legend if legend is not None else {}))
+
+    if file_name is not None:
+        plt.savefig(file_name, format = file_name.rsplit('.', 1)[-1])
+
+    if show is True:
+        plt.show()
+
+    plt.close()
+
+
+# plot index values of the given rows of a result store, values are read from the memory mapped store row by row
+def plot_store(store, rows: List[int], labels: List[str], title: str, file_name: str, show: bool = False):
+    index_values = store.values('index_values')
+    plot_values(store.dates, [(label, index_values[row]) for (row, label) in zip(rows, labels)], title,
+                file_name = file_name,
+                show = show,
+                legend = {'loc': 'upper center', 'bbox_to_anchor': (0.5, -0.05), 'fancybox': True, 'shadow': True, 'ncol': 5})
@@ -0,0 +1,114 @@
+from typing import Dict, Iterator, List
+import json
+import os
+
+import numpy as np
+
+# value series stored for every configuration
+SERIES = ['index_values', 'baseline_values']
+
+
+# value of a configuration net of its fees, fees deducted from the portfolio are already part of the value
+def net_value(value: float, fees: float, configuration: Dict) -> float:
+    return value if configuration.get('deduct_fee', False) is True else value - fees
+
+
+class ResultStore(object):
+    # on-disk columnar store of simulation results sharing the same dates. The directory holds the date axis
+    # (dates.json), one raw array file per value series (<series>.bin) with one row of len(dates) values appended per
+    # configuration and a parameter table (parameters.jsonl) with the configuration and summary of every row. Nothing
+    # but the open files is kept in memory, i.e. memory usage does not depend on the number of stored results.
+    #
+    # The parameter table is written last, hence values of a row interrupted while being written are dropped when
+    # the store is reopened.
+    def __init__(self, dir_name: str, dtype = np.float64, append: bool = False):
+        self.dir_name = dir_name
+        self.dtype = np.dtype(dtype)
+        self.dates: List[str] = None
+        self.rows = 0
+
+        os.makedirs(dir_name, exist_ok = True)
+        self.dates_file_name = os.path.join(dir_name, 'dates.json')
+        self.parameters_file_name = os.path.join(dir_name, 'parameters.jsonl')
+        self.series_file_names = {series: os.path.join(dir_name, f"{series}.bin") for series in SERIES}
+
+        if append is True and os.path.exists(self.dates_file_name):
+            with open(self.dates_file_name, 'r') as file:
+                header = json.loads(file.read())
+            if header['dtype'] != self.dtype.str:
+                raise Exception(f"Result store {dir_name} holds values of type {header['dtype']}, not {self.dtype.str}")
+            self.dates = header['dates']
+
+            if os.path.exists(self.parameters_file_name):
+                with open(self.parameters_file_name, 'r') as file:
+                    self.rows = sum(1 for line in file if line.strip() != '')
+
+            # drop values of an unfinished row
+            for file_name in self.series_file_names.values():
+                with open(file_name, 'ab') as file:
+                    file.truncate(self.rows * len(self.dates) * self.dtype.itemsize)
+        else:
+            for file_name in [self.dates_file_name, self.parameters_file_name] + list(self.series_file_names.values()):
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+
+        self.parameters_file = open(self.parameters_file_name, 'a')
+        self.series_files = {series: open(file_name, 'ab') for (series, file_name) in self.series_file_names.items()}
+
+    # store result of a configuration and return its row. Summary of the result is calculated right away so that
+    # results can be compared without loading the value series.
+    def append(self, configuration: Dict, dates: List[str], baseline_values: List[float], index_values: List[float], fees: float) -> int:
+        if self.dates is None:
+            self.dates = list(dates)
+            with open(self.dates_file_name, 'w') as file:
+                file.write(json.dumps({'dtype': self.dtype.str, 'dates': self.dates}))
+        elif len(dates) != len(self.dates) or dates[0] != self.dates[0] or dates[-1] != self.dates[-1]:
+            raise Exception(f"Result dates [{dates[0]} - {dates[-1]}] differ from dates of the store [{self.dates[0]} - {self.dates[-1]}]")
+
+        values = {'index_values': np.asarray(index_values, dtype = np.float64),
+                  'baseline_values': np.asarray(baseline_values, dtype = np.float64)}
+        for series in SERIES:
+            values[series].astype(self.dtype).tofile(self.series_files[series])
+            self.series_files[series].flush()
+
+        summary = {
+            'row': self.rows,
+            'configuration': configuration,
+            'final_value': float(values['index_values'][-1]),
+            'max_value': float(values['index_values'].max()),
+            'baseline_final_value': float(values['baseline_values'][-1]),
+            'fees': float(fees),
+        }
+        self.parameters_file.write(json.dumps(summary))
+        self.parameters_file.write("\n")
+        self.parameters_file.flush()
+
+        self.rows += 1
+        return summary['row']
+
+    # summaries of all stored results in order of their rows
+    def summaries(self) -> Iterator[Dict]:
+        self.parameters_file.flush()
+        with open(self.parameters_file_name, 'r') as file:
+            for line in file:
+                if line.strip() != '':
+                    yield json.loads(line)
+
+    # memory mapped (rows x dates) array of a value series
+    def values(self, series: str) -> np.ndarray:
+        if self.rows == 0:
+            return np.zeros((0, len(self.dates) if self.dates is not None else 0), dtype = self.dtype)
+
+        self.series_files[series].flush()
+        return np.memmap(self.series_file_names[series], dtype = self.dtype, mode = 'r', shape = (self.rows, len(self.dates)))
+
+    def close(self):
+        self.parameters_file.close()
+        for file in self.series_files.values():
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,188 @@
+from typing import Dict, Iterable, List
+from array import array
+import itertools
+import json
+import os
+
+import numpy as np
+
+from DataStore import DataStore, read_records
+from MarketData import MarketData, STORED_FIELDS, calc_listing, write_json
+
+# length of a row of resampled views in seconds
+RESOLUTIONS = {
+    'hour': 3600,
+    'day': 86400,
+    'week': 7 * 86400,
+}
+
+# weeks start on Monday (the epoch is a Thursday)
+ORIGINS = {
+    'week': 4 * 86400,
+}
+
+# aggregation of samples falling into the same row. Price and capitalization are taken from the first sample of the
+# row (as the daily download did), volumes downloaded are 24 hour volumes, hence they are averaged so that volume
+# filters keep their meaning at every resolution.
+AGGREGATIONS = {
+    'price': 'open',
+    'cap': 'open',
+    'volume': 'mean',
+}
+
+
+class SampleStore(object):
+    # timestamped market samples at their native resolution. Samples are ordered by coin and time, samples of coin i
+    # are stored in rows [offsets[i], offsets[i + 1]) of the flat arrays timestamp (seconds since epoch, UTC) and
+    # price, cap and volume. Unlike MarketData, no (time x coin) matrix is kept, i.e. size of the store depends only
+    # on the number of samples.
+    #
+    # Simulations consume MarketData views resampled to a given resolution, views are built on demand and memoized.
+    def __init__(self, coins: List[str], offsets: np.ndarray, timestamp: np.ndarray, price: np.ndarray, cap: np.ndarray, volume: np.ndarray):
+        self.coins = coins
+        self.offsets = offsets
+        self.timestamp = timestamp
+        self.price = price
+        self.cap = cap
+        self.volume = volume
+
+        self.views: Dict = {}
+
+    # build the store from a stream of sample records {'timestamp': ..., 'coin': ..., 'price': ..., 'cap': ..., 'volume': ...}
+    # in any order. If a coin holds several samples with the same timestamp, the last one wins.
+    @classmethod
+    def from_records(cls, records: Iterable[Dict]) -> 'SampleStore':
+        coin_index = {}
+        cols = array('q')
+        timestamps = array('q')
+        values = {field: array('d') for field in STORED_FIELDS}
+        for record in records:
+            cols.append(coin_index.setdefault(record['coin'], len(coin_index)))
+            timestamps.append(int(record['timestamp']))
+            for field in STORED_FIELDS:
+                values[field].append(record.get(field) or 0)
+
+        cols = np.frombuffer(cols, dtype = np.int64)
+        timestamp = np.frombuffer(timestamps, dtype = np.int64)
+
+        # order by coin and time keeping the order of appearance of equal samples, then keep the last one of them
+        order = np.lexsort((np.arange(len(cols)), timestamp, cols))
+        last = np.ones(len(order), dtype = bool)
+        last[:-1] = (cols[order][1:] != cols[order][:-1]) | (timestamp[order][1:] != timestamp[order][:-1])
+        order = order[last]
+
+        offsets = np.zeros(len(coin_index) + 1, dtype = np.int64)
+        offsets[1:] = np.cumsum(np.bincount(cols[order], minlength = len(coin_index)))
+
+        arrays = {field: np.frombuffer(values[field], dtype = np.float64)[order] for field in STORED_FIELDS}
+
+        return cls(list(coin_index.keys()), offsets, timestamp[order], **arrays)
+
+    # load samples downloaded into a DataStore (see download_input_data.py). A binary copy is kept in the
+    # subdirectory binary and memory mapped on subsequent loads as long as no other coin has been downloaded.
+    @classmethod
+    def load(cls, dir_name: str) -> 'SampleStore':
+        data_store = DataStore(dir_name)
+        chunk_file_names = data_store.chunk_file_names()
+        binary_dir = os.path.join(dir_name, 'binary')
+
+        index_file_name = os.path.join(binary_dir, 'index.json')
+        if os.path.exists(index_file_name):
+            with open(index_file_name, 'r') as file:
+                if json.loads(file.read())['source'] == chunk_file_names:
+                    return cls.open(binary_dir)
+
+        store = cls.from_records(itertools.chain.from_iterable(read_records(file_name) for file_name in chunk_file_names))
+        store.save(binary_dir, chunk_file_names)
+
+        return cls.open(binary_dir)
+
+    # store the samples in a binary format, one raw .npy file per array and an index file written last
+    def save(self, dir_name: str, source = None):
+        os.makedirs(dir_name, exist_ok = True)
+
+        index_file_name = os.path.join(dir_name, 'index.json')
+        if os.path.exists(index_file_name):
+            os.remove(index_file_name)
+
+        for field in ['offsets', 'timestamp'] + STORED_FIELDS:
+            np.save(os.path.join(dir_name, f"{field}.tmp.npy"), np.ascontiguousarray(getattr(self, field)))
+            os.replace(os.path.join(dir_name, f"{field}.tmp.npy"), os.path.join(dir_name, f"{field}.npy"))
+
+        write_json(index_file_name, {'source': source, 'coins': self.coins})
+
+    # open samples stored by save(), arrays are memory mapped read-only
+    @classmethod
+    def open(cls, dir_name: str) -> 'SampleStore':
+        with open(os.path.join(dir_name, 'index.json'), 'r') as file:
+            index = json.loads(file.read())
+
+        arrays = {field: np.load(os.path.join(dir_name, f"{field}.npy"), mmap_mode = 'r') for field in ['offsets', 'timestamp'] + STORED_FIELDS}
+
+        return cls(index['coins'], **arrays)
+
+    # market data with one row per [resolution] period holding samples aggregated by [aggregations] (open, close,
+    # high, low, mean or sum; see AGGREGATIONS for defaults). Only periods with at least one sample get a row, rows
+    # are labeled by the start of the period, i.e. YYYY-MM-DD or YYYY-MM-DD HH:MM for sub-daily resolutions.
+    def resample(self, resolution: str = 'day', aggregations: Dict[str, str] = None) -> MarketData:
+        if resolution not in RESOLUTIONS:
+            raise Exception(f"Resolution {resolution} is not supported, use one of {list(RESOLUTIONS.keys())}")
+
+        aggregations = {**AGGREGATIONS, **(aggregations if aggregations is not None else {})}
+        key = (resolution, tuple(aggregations[field] for field in STORED_FIELDS))
+        if key in self.views:
+            return self.views[key]
+
+        period = RESOLUTIONS[resolution]
+        origin = ORIGINS.get(resolution, 0)
+
+        cols = np.repeat(np.arange(len(self.coins)), np.diff(self.offsets))
+        periods = (np.asarray(self.timestamp) - origin) // period
+
+        # groups of consecutive samples of the same coin and period
+        starts = np.ones(len(periods), dtype = bool)
+        starts[1:] = (cols[1:] != cols[:-1]) | (periods[1:] != periods[:-1])
+        starts = np.flatnonzero(starts)
+        ends = np.append(starts[1:], len(periods)) - 1
+
+        row_periods = np.unique(periods[starts])
+        rows = np.searchsorted(row_periods, periods[starts])
+        group_cols = cols[starts]
+
+        arrays = {}
+        for field in STORED_FIELDS:
+            arrays[field] = np.zeros((len(row_periods), len(self.coins)))
+            arrays[field][rows, group_cols] = aggregate(np.asarray(getattr(self, field)), starts, ends, aggregations[field])
+
+        # listing intervals of the coins are given by the rows they have samples in
+        observed = np.zeros(len(rows), dtype = bool)
+        for field in STORED_FIELDS:
+            observed |= arrays[field][rows, group_cols] != 0
+        listing = calc_listing(rows[observed], group_cols[observed], len(self.coins))
+
+        labels = np.datetime_as_string((row_periods * period + origin).astype('datetime64[s]'), unit = 'm' if period < 86400 else 'D')
+        dates = [label.replace('T', ' ') for label in labels.tolist()]
+
+        self.views[key] = MarketData(dates, list(self.coins), listing = listing, **arrays)
+        return self.views[key]
+
+
+# aggregate values of groups [starts[i], ends[i]] of consecutive samples
+def aggregate(values: np.ndarray, starts: np.ndarray, ends: np.ndarray, aggregation: str) -> np.ndarray:
+    if len(starts) == 0:
+        return values[:0]
+
+    if aggregation == 'open':
+        return values[starts]
+    elif aggregation == 'close':
+        return values[ends]
+    elif aggregation == 'high':
+        return np.maximum.reduceat(values, starts)
+    elif aggregation == 'low':
+        return np.minimum.reduceat(values, starts)
+    elif aggregation == 'sum':
+        return np.add.reduceat(values, starts)
+    elif aggregation == 'mean':
+        return np.add.reduceat(values, starts) / (ends - starts + 1)
+
+    raise Exception(f"Aggregation {aggregation} is not supported")
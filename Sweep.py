@@ -0,0 +1,277 @@
+from typing import Callable, Dict, Iterator, List, Tuple
+import itertools
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+
+from BatchBCI import BatchBCI
+from BCI import BCI, validate_configuration
+from Instrumentation import Timings
+from MarketData import MarketData, PreparedMarketData
+from ResultStore import ResultStore, net_value
+
+LOG = logging.getLogger(__name__)
+
+# market data shared by the worker processes. With the fork start method the arrays are inherited from the parent
+# (copy-on-write, never written to), otherwise they are transferred once per worker by the pool initializer.
+_prepared_data: PreparedMarketData = None
+
+# whether the workers collect timings of the simulations
+_collect_timings = False
+
+
+def _init_worker(prepared_data: PreparedMarketData, collect_timings: bool = False):
+    global _prepared_data, _collect_timings
+    _prepared_data = prepared_data
+    _collect_timings = collect_timings
+
+
+# run a batch of configurations sharing the same data and rebalancing schedule in lockstep. Timings of the batch are
+# returned along with the results if collected.
+def _run_batch(job: List[Tuple[int, Dict]]) -> Tuple[List[Tuple[int, List, Exception]], Timings]:
+    timings = Timings() if _collect_timings is True else None
+    started = timings.start() if timings is not None else None
+
+    results = []
+    simulations = []
+    for (i, configuration) in job:
+        try:
+            market_data = _prepared_data.get(configuration.get('start_dt'), configuration.get('end_dt'), configuration['running_avg_volume_period'])
+            simulations.append((i, BCI(**configuration, market_data = market_data, timings = timings)))
+        except Exception as e:
+            results.append((i, None, e))
+
+    # an unexpected failure of the batch fails its simulations only, not the whole sweep
+    if len(simulations) > 0:
+        try:
+            batch_results = BatchBCI([bci for (_, bci) in simulations], timings).run()
+        except Exception as e:
+            batch_results = [(None, e)] * len(simulations)
+        for ((i, _), (result, error)) in zip(simulations, batch_results):
+            results.append((i, result, error))
+
+    if timings is not None:
+        timings.count('batches')
+        timings.count('simulations', len(job))
+        timings.stop('batch', started)
+
+    return results, timings
+
+
+# expand a declarative parameter grid {'parameter': [value1, value2, ...], ...} into a list of BCI configurations.
+# Derived parameters are calculated from the already expanded ones and configurations not satisfying all
+# constraints are dropped.
+def expand_grid(grid: Dict[str, List],
+                derived: Dict[str, Callable[[Dict], object]] = None,
+                constraints: List[Callable[[Dict], bool]] = None) -> List[Dict]:
+    configurations = []
+    for values in itertools.product(*grid.values()):
+        configuration = dict(zip(grid.keys(), values))
+
+        if constraints is not None and not all(constraint(configuration) for constraint in constraints):
+            continue
+
+        if derived is not None:
+            for parameter, func in derived.items():
+                configuration[parameter] = func(configuration)
+
+        configurations.append(configuration)
+
+    return configurations
+
+
+# windows (start date, end date) of [length] consecutive dates starting every [step] dates
+def walk_forward_windows(dates: List[str], length: int, step: int) -> List[Tuple[str, str]]:
+    return [(dates[i], dates[i + length - 1]) for i in range(0, len(dates) - length + 1, step)]
+
+
+class Sweep(object):
+    # configurations sharing the dates and rebalancing schedule are simulated in batches of up to [batch_size]
+    # timings of the sweep (including the simulations run by the workers) are collected if a Timings instance
+    # is provided
+    def __init__(self, market_data: MarketData, processes: int = None, batch_size: int = 32, timings: Timings = None):
+        self.market_data = market_data
+        self.processes = processes if processes is not None else os.cpu_count()
+        self.batch_size = batch_size
+        self.timings = timings
+
+    # drop duplicate configurations and reject invalid ones before anything gets simulated. Returns unique valid
+    # configurations and tuples (configuration, exception) of the rejected ones.
+    def plan(self, configurations: List[Dict]) -> Tuple[List[Dict], List[Tuple[Dict, Exception]]]:
+        planned = {}
+        rejected = []
+        for configuration in configurations:
+            key = tuple(sorted(configuration.items()))
+            if key in planned:
+                continue
+
+            if configuration.get('bypass_validation', False) is False:
+                try:
+                    validate_configuration(configuration)
+                except Exception as e:
+                    rejected.append((configuration, e))
+                    continue
+
+            planned[key] = configuration
+
+        LOG.debug(f"Planned {len(planned)} configurations out of {len(configurations)} "
+                  f"({len(rejected)} invalid, {len(configurations) - len(planned) - len(rejected)} duplicates)")
+
+        return list(planned.values()), rejected
+
+    # run BCI simulation for every unique configuration. Results are yielded in order of completion as tuples
+    # (configuration, [dates, baseline values, index values, fees], exception) where either the result or the
+    # exception is None. Invalid configurations are yielded with their exception right away.
+    #
+    # With more than one rung, configurations are selected by successive halving: all configurations are simulated
+    # over the first 1 / eta^(rungs - 1) of their dates, only the best 1 / eta of them are simulated over an eta times
+    # longer prefix and so on until the remaining ones are simulated over all dates. Only results of the last rung are
+    # yielded. Configurations are compared by score (final index value net of fees by default) with configurations
+    # of the same date window.
+    def run(self,
+            configurations: List[Dict],
+            rungs: int = 1,
+            eta: int = 3,
+            score: Callable[[List], float] = None) -> Iterator[Tuple[Dict, List, Exception]]:
+        started = self.timings.start() if self.timings is not None else None
+        (configurations, rejected) = self.plan(configurations)
+        if self.timings is not None:
+            self.timings.stop('sweep_plan', started)
+        for (configuration, error) in rejected:
+            yield configuration, None, error
+
+        if score is None:
+            rank = lambda configuration, result: net_value(result[2][-1], result[3], configuration)
+        else:
+            rank = lambda configuration, result: score(result)
+
+        for rung in range(rungs - 1, 0, -1):
+            # prefix of the dates simulated in this rung for every date window
+            prefix_end_dts = {}
+            for configuration in configurations:
+                window = (configuration.get('start_dt'), configuration.get('end_dt'))
+                if window not in prefix_end_dts:
+                    dates = self.market_data.window(*window).dates
+                    prefix_end_dts[window] = dates[max(1, len(dates) // eta ** rung) - 1] if len(dates) > 0 else window[1]
+
+            # keep the best configurations of every date window (ties in favour of the grid order), failed ones
+            # are dropped
+            prefixes = [dict(configuration, end_dt = prefix_end_dts[(configuration.get('start_dt'), configuration.get('end_dt'))]) for configuration in configurations]
+            originals = {id(prefix): i for (i, prefix) in enumerate(prefixes)}
+            windows = {}
+            for (prefix, result, error) in self.execute(prefixes):
+                if error is None:
+                    i = originals[id(prefix)]
+                    windows.setdefault((configurations[i].get('start_dt'), configurations[i].get('end_dt')), []).append((-rank(configurations[i], result), i))
+
+            survivors = []
+            for candidates in windows.values():
+                survivors += [i for (_, i) in sorted(candidates)[:max(1, len(candidates) // eta)]]
+            survivors = [configurations[i] for i in sorted(survivors)]
+
+            LOG.debug(f"Successive halving: {len(survivors)} out of {len(configurations)} configurations continue")
+            configurations = survivors
+
+        yield from self.execute(configurations)
+
+    # run BCI simulation for every configuration, see run()
+    def execute(self, configurations: List[Dict]) -> Iterator[Tuple[Dict, List, Exception]]:
+        started = self.timings.start() if self.timings is not None else None
+
+        # prepare data for all configurations and rank coins on all dates used for (re)balancing before the workers
+        # are started so that they inherit them
+        data_keys = set((configuration.get('start_dt'), configuration.get('end_dt'), configuration['running_avg_volume_period']) for configuration in configurations)
+        prepared_data = PreparedMarketData(self.market_data, max(len(data_keys), 16))
+        self.market_data.calc_running_avg_volume(list(set(key[2] for key in data_keys)))
+
+        # as well as liquid universes of all volume filters used on the rebalancing dates
+        ranking_sizes = {}
+        thresholds = {}
+        for configuration in configurations:
+            key = (configuration.get('start_dt'), configuration.get('end_dt'), configuration['running_avg_volume_period'], configuration['rebalancing_period'])
+            size = configuration['offset'] + max(configuration['index_size'], configuration['index_candidate_size'])
+            ranking_sizes[key] = max(size, ranking_sizes.get(key, 0))
+            thresholds.setdefault(key, set()).update([configuration['primary_usd_filtering'], configuration['secondary_usd_filtering']])
+        for ((start_dt, end_dt, running_avg_volume_period, rebalancing_period), size) in ranking_sizes.items():
+            market_data = prepared_data.get(start_dt, end_dt, running_avg_volume_period)
+            if len(market_data.dates) > 0:
+                schedule = market_data.rebalance_schedule(rebalancing_period)
+                market_data.calc_cap_rankings([0] + schedule, size)
+                market_data.calc_liquid_universes(schedule, sorted(thresholds[(start_dt, end_dt, running_avg_volume_period, rebalancing_period)]))
+
+        if self.timings is not None:
+            self.timings.stop('sweep_prepare', started)
+
+        LOG.debug(f"Running {len(configurations)} configurations in {self.processes} processes")
+
+        batches = {}
+        for (i, configuration) in enumerate(configurations):
+            key = (configuration.get('start_dt'), configuration.get('end_dt'), configuration['running_avg_volume_period'], configuration['rebalancing_period'])
+            batches.setdefault(key, []).append((i, configuration))
+        jobs = [batch[j:j + self.batch_size] for batch in batches.values() for j in range(0, len(batch), self.batch_size)]
+
+        if self.processes == 1:
+            _init_worker(prepared_data, self.timings is not None)
+            for (results, timings) in map(_run_batch, jobs):
+                if timings is not None:
+                    self.timings.merge(timings)
+                for (i, result, error) in results:
+                    yield configurations[i], result, error
+            return
+
+        if 'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing.get_context()
+
+        chunk_size = max(1, len(jobs) // (self.processes * 16))
+        with context.Pool(self.processes, initializer = _init_worker, initargs = (prepared_data, self.timings is not None)) as pool:
+            for (results, timings) in pool.imap_unordered(_run_batch, jobs, chunk_size):
+                if timings is not None:
+                    self.timings.merge(timings)
+                for (i, result, error) in results:
+                    yield configurations[i], result, error
+
+    # run BCI simulation for every configuration and stream the results into a result store as they complete.
+    # Failed configurations are returned as tuples (configuration, exception).
+    def run_into(self, configurations: List[Dict], store: ResultStore, **kwargs) -> List[Tuple[Dict, Exception]]:
+        errors = []
+        for (configuration, result, error) in self.run(configurations, **kwargs):
+            if error is not None:
+                errors.append((configuration, error))
+                continue
+
+            [dates, baseline_values, index_values, fees] = result
+            store.append(configuration, dates, baseline_values, index_values, fees)
+
+        return errors
+
+    # run the configuration over every window (start date, end date). Data are prepared once, windows are views of
+    # them simulated in parallel. Returns one row per window ordered as the windows with the outcome of the
+    # simulation or the error.
+    def walk_forward(self, configuration: Dict, windows: List[Tuple[str, str]]) -> List[Dict]:
+        configurations = [dict(configuration, start_dt = start_dt, end_dt = end_dt) for (start_dt, end_dt) in windows]
+        rows = {window: {'start_dt': window[0], 'end_dt': window[1]} for window in windows}
+
+        for (configuration, result, error) in self.run(configurations):
+            row = rows[(configuration['start_dt'], configuration['end_dt'])]
+            if error is not None:
+                row['error'] = str(error)
+                continue
+
+            [dates, baseline_values, index_values, fees] = result
+            index_values = np.array(index_values)
+            peak_values = np.maximum.accumulate(index_values)
+            row.update({
+                'days': len(dates),
+                'index_value': float(index_values[-1]),
+                'baseline_value': float(baseline_values[-1]),
+                'fees': fees,
+                'index_return': float(index_values[-1] / configuration['initial_funds'] - 1),
+                'baseline_return': float(baseline_values[-1] / configuration['initial_funds'] - 1),
+                'max_drawdown': float(np.max(1 - np.divide(index_values, peak_values, out = np.ones(len(index_values)), where = peak_values > 0))),
+            })
+
+        return [rows[window] for window in windows]
@@ -0,0 +1,49 @@
+from typing import Dict, List, NamedTuple, Tuple
+import json
+
+
+class RebalanceRecord(NamedTuple):
+    # state of the index after the initial allocation or a rebalancing on [date]
+    date: str
+    candidates: List[str]
+    composition: List[str]
+    allocation: List[Tuple[str, float]]
+    portfolio: Dict[str, float]
+    portfolio_value: float
+    trades: Dict[str, float]
+    fee: float
+    baseline_value: float
+
+
+class TraceWriter(object):
+    # writes records of a simulation into a JSONL file, one record per line tagged by the record type. Nothing is
+    # collected nor formatted unless a writer is passed to the simulation.
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.file = open(file_name, 'w')
+
+    def write(self, record: NamedTuple):
+        self.file.write(json.dumps({'record': type(record).__name__, **record._asdict()}))
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def read_trace(file_name: str) -> List[RebalanceRecord]:
+    records = []
+    with open(file_name, 'r') as file:
+        for line in file:
+            if line.strip() != '':
+                record = json.loads(line)
+                if record.pop('record') == RebalanceRecord.__name__:
+                    record['allocation'] = [tuple(x) for x in record['allocation']]
+                    records.append(RebalanceRecord(**record))
+
+    return records
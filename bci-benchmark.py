@@ -0,0 +1,235 @@
+import logging
+import sys
+import json
+import time
+import datetime
+import platform
+import argparse
+import tracemalloc
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from BCI import BCI
+from MarketData import MarketData
+from Sweep import Sweep, expand_grid
+
+logger = logging.getLogger('BCI')
+logger.setLevel(logging.WARN)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+logger = logging.getLogger('__main__')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+LOG = logging.getLogger(__name__)
+
+STAGES = ['from_dict', 'set_input_data', 'calc_running_avg_volume', 'prune_dates', 'run', 'sweep']
+
+# BCI5 configuration (see bci5.sh)
+CONFIGURATION = {
+    'index_size': 5,
+    'rebalancing_period': 0,
+    'primary_usd_filtering': 600000,
+    'secondary_usd_filtering': 1000000,
+    'max_asset_allocation': 0.35,
+    'fee': 0.02,
+    'running_avg_volume_period': 30,
+    'index_candidate_size': 10,
+    'primary_candidate_size': 3,
+    'secondary_candidate_size': 7,
+    'initial_funds': 1000,
+    'offset': 0,
+}
+
+SWEEP_GRID = {
+    'index_size': [5, 10],
+    'rebalancing_period': [0, 60],
+    'primary_usd_filtering': [600000, 1000000],
+    'secondary_usd_filtering': [1000000, 2000000],
+    'max_asset_allocation': [0.2, 0.35, 0.5],
+    'running_avg_volume_period': [30],
+    'primary_candidate_size': [3, 5],
+    'offset': [0, 5, 10],
+}
+
+
+def parse_args() -> dict:
+    parser = argparse.ArgumentParser(description = 'Bitpanda Crypto Index Simulator benchmark')
+
+    parser.add_argument('--coins', help = 'Number of coins of the synthetic market', default = 1000, type = int)
+    parser.add_argument('--days', help = 'Number of days of the synthetic market', default = 5 * 365, type = int)
+    parser.add_argument('--sparsity', help = 'Fraction of coin-days without data (coins not listed yet or already delisted)', default = 0.5, type = float)
+    parser.add_argument('--seed', help = 'Seed of the synthetic market', default = 1, type = int)
+    parser.add_argument('--stages', help = 'Stages to benchmark', nargs = '+', default = STAGES, choices = STAGES)
+    parser.add_argument('--repeat', help = 'Number of repetitions of every stage, the best time is reported', default = 3, type = int)
+    parser.add_argument('--processes', help = 'Number of worker processes of the sweep. All available cores by default', default = None, type = int)
+    parser.add_argument('--output', help = 'JSON file the results are stored into', default = None)
+    parser.add_argument('--compare', help = 'JSON file with results of a previous run to compare with', default = None)
+    parser.add_argument('--threshold', help = 'Relative slowdown of a stage reported as a regression', default = 0.1, type = float)
+
+    return vars(parser.parse_args())
+
+
+# deterministic synthetic market. Every coin is listed for (1 - sparsity) of all days starting on a random day, its
+# price follows a geometric random walk, capitalization is given by a fixed supply and daily volume is a random
+# fraction of the supply. Coin-days outside the listing are zeros as in the real input data.
+def generate_market_data(coins: int, days: int, sparsity: float = 0.5, seed: int = 1, start_dt: str = "2015-01-01") -> MarketData:
+    rng = np.random.default_rng(seed)
+
+    start = datetime.datetime.strptime(start_dt, "%Y-%m-%d")
+    dates = [(start + datetime.timedelta(days = i)).strftime("%Y-%m-%d") for i in range(days)]
+
+    listed_days = max(1, int(round(days * (1 - sparsity))))
+    listed = rng.integers(0, days - listed_days + 1, coins)
+    active = np.arange(days)[:, np.newaxis] - listed
+    active = (active >= 0) & (active < listed_days)
+
+    price = 10 ** rng.uniform(-3, 4, coins) * np.exp(np.cumsum(rng.normal(0, 0.05, (days, coins)), axis = 0))
+    supply = 10 ** rng.uniform(5, 10, coins)
+    volume = supply * rng.uniform(0.001, 0.2, (days, coins))
+
+    price = np.where(active, price, 0)
+    cap = price * supply
+    volume = np.where(active, volume, 0)
+
+    return MarketData(dates, [f"C{i:05d}" for i in range(coins)], price, cap, volume, listing = (listed, listed + listed_days))
+
+
+# view of the market data without any derived data (running average volumes, rankings) so that stages always start
+# from scratch. Listing intervals are part of the loaded data, hence they are kept.
+def fresh(market_data: MarketData) -> MarketData:
+    return MarketData(market_data.dates, market_data.coins, market_data.price, market_data.cap, market_data.volume,
+                      coin_index = market_data.coin_index,
+                      listing = market_data.listing)
+
+
+# time [repeat] runs of func (setup is not timed), then measure peak memory allocated during one more run
+def measure(func: Callable, setup: Callable = None, repeat: int = 3) -> Dict:
+    wall = []
+    cpu = []
+    for _ in range(repeat):
+        args = setup() if setup is not None else ()
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        func(*args)
+        cpu.append(time.process_time() - start_cpu)
+        wall.append(time.perf_counter() - start_wall)
+
+    args = setup() if setup is not None else ()
+    tracemalloc.start()
+    func(*args)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'wall': min(wall), 'cpu': min(cpu), 'peak_memory': peak_memory}
+
+
+def benchmark(market_data: MarketData, stages: List[str], repeat: int, processes: int) -> Dict:
+    start_dt = market_data.dates[len(market_data.dates) // 5]
+    end_dt = market_data.dates[-1]
+
+    def new_bci(**kwargs) -> BCI:
+        return BCI(**CONFIGURATION, start_dt = start_dt, end_dt = end_dt, **kwargs)
+
+    results = {}
+    if 'from_dict' in stages:
+        input_data = market_data.to_dict()
+        results['from_dict'] = measure(lambda: MarketData.from_dict(input_data), repeat = repeat)
+        del input_data
+
+    if 'set_input_data' in stages:
+        results['set_input_data'] = measure(lambda bci, data: bci.set_input_data(data),
+                                            lambda: (new_bci(bypass_validation = True), fresh(market_data)), repeat)
+
+    def with_data() -> tuple:
+        bci = new_bci(bypass_validation = True)
+        bci.data = fresh(market_data)
+        return bci,
+
+    if 'calc_running_avg_volume' in stages:
+        results['calc_running_avg_volume'] = measure(lambda bci: bci.calc_running_avg_volume(), with_data, repeat)
+
+    if 'prune_dates' in stages:
+        results['prune_dates'] = measure(lambda bci: bci.prune_dates(start_dt, end_dt), with_data, repeat)
+
+    if 'run' in stages:
+        results['run'] = measure(lambda bci: bci.run(), lambda: (new_bci(market_data = fresh(market_data)),), repeat)
+
+    if 'sweep' in stages:
+        configurations = expand_grid(
+            SWEEP_GRID,
+            derived = {
+                'fee': lambda x: CONFIGURATION['fee'],
+                'index_candidate_size': lambda x: x['index_size'] * 2,
+                'secondary_candidate_size': lambda x: x['primary_candidate_size'] + 5,
+                'initial_funds': lambda x: CONFIGURATION['initial_funds'],
+                'start_dt': lambda x: start_dt,
+                'end_dt': lambda x: end_dt,
+            },
+            constraints = [
+                lambda x: x['primary_usd_filtering'] < x['secondary_usd_filtering'],
+                lambda x: x['primary_candidate_size'] <= x['index_size'],
+            ])
+
+        # peak memory covers the parent process only
+        results['sweep'] = measure(lambda sweep: list(sweep.run(configurations)),
+                                   lambda: (Sweep(fresh(market_data), processes),), repeat)
+        results['sweep']['configurations'] = len(configurations)
+
+    return results
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> bool:
+    if baseline['parameters'] != results['parameters']:
+        LOG.info(f"Warning: compared runs differ in parameters {baseline['parameters']} vs {results['parameters']}")
+
+    regression = False
+    LOG.info(f"\n{'stage':<25}{'baseline [s]':>14}{'current [s]':>14}{'ratio':>8}{'baseline [MB]':>15}{'current [MB]':>14}")
+    for (stage, result) in results['stages'].items():
+        if stage not in baseline['stages']:
+            continue
+
+        previous = baseline['stages'][stage]
+        ratio = result['wall'] / previous['wall'] if previous['wall'] > 0 else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            regression = True
+            flag = ' REGRESSION'
+
+        LOG.info(f"{stage:<25}{previous['wall']:>14.4f}{result['wall']:>14.4f}{ratio:>8.2f}"
+                 f"{previous['peak_memory'] / 2 ** 20:>15.1f}{result['peak_memory'] / 2 ** 20:>14.1f}{flag}")
+
+    return regression
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    parameters = {parameter: args[parameter] for parameter in ['coins', 'days', 'sparsity', 'seed']}
+    market_data = generate_market_data(**parameters)
+    LOG.info(f"Synthetic market: {len(market_data.coins)} coins, {len(market_data.dates)} days "
+             f"({market_data.dates[0]} - {market_data.dates[-1]}), sparsity {args['sparsity']}")
+
+    results = {
+        'parameters': parameters,
+        'repeat': args['repeat'],
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'timestamp': datetime.datetime.now().isoformat(timespec = 'seconds'),
+        'stages': benchmark(market_data, args['stages'], args['repeat'], args['processes']),
+    }
+
+    LOG.info(f"\n{'stage':<25}{'wall [s]':>12}{'cpu [s]':>12}{'peak [MB]':>12}")
+    for (stage, result) in results['stages'].items():
+        LOG.info(f"{stage:<25}{result['wall']:>12.4f}{result['cpu']:>12.4f}{result['peak_memory'] / 2 ** 20:>12.1f}")
+
+    if args['output'] is not None:
+        with open(args['output'], 'w') as file:
+            file.write(json.dumps(results, indent = 2))
+
+    if args['compare'] is not None:
+        with open(args['compare'], 'r') as file:
+            if compare(results, json.loads(file.read()), args['threshold']):
+                sys.exit(1)
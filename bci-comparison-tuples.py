@@ -2,9 +2,8 @@ import logging
 import sys
 import json
 
-import matplotlib.pyplot as plt
-
 from BCI import BCI
+from MarketData import MarketData, PreparedMarketData
 
 logger = logging.getLogger('matplotlib')
 logger.setLevel(logging.WARN)
@@ -52,12 +51,10 @@ if __name__ == "__main__":
     start_dt = "2020-01-01"
     end_dt = "2020-11-01"
 
-    with open("input_data.json", 'r') as file:
-        input_data = json.loads(file.read())
-
-    data = None
-    dates = None
-    data_by_coin = None
+    # calculate running average volumes of all compared periods in a single pass
+    market_data = MarketData.load("input_data.json")
+    market_data.calc_running_avg_volume([parameter[5] for parameter in parameters])
+    prepared_data = PreparedMarketData(market_data)
 
     results = []
     for (index,
@@ -96,25 +93,13 @@ if __name__ == "__main__":
                 secondary_candidate_size = secondary_candidate,
                 initial_funds = 1000,
                 offset = offset,
+                market_data = prepared_data.get(start_dt, end_dt, running_avg_volume_period),
                 start_dt = start_dt,
                 end_dt = end_dt
             )
 
-            # use previously calculated data to save initialization time
-            if data_by_coin is None:
-                bci.set_input_data(input_data)
-            else:
-                bci.data = data
-                bci.dates = dates
-                bci.data_by_coin = data_by_coin
-
             [dates, baseline_values, index_values, fees] = bci.run()
             results.append([dates, index_values, fees, baseline_values, label])
-
-            if data_by_coin is None:
-                data = bci.data
-                dates = bci.dates
-                data_by_coin = bci.data_by_coin
         except Exception as e:
             LOG.debug(e)
 
@@ -136,21 +121,10 @@ if __name__ == "__main__":
                 file.write(f"{';'.join(map(str, data[4]))};{data[1][-1]};{data[3][-1]};{data[2]}\n")
 
     if GRAPH is True:
-        dates = None
-        for data in results[-10:]:
-            dates = data[0]
-            plt.plot(data[0], data[1], label = str(data[4]), linewidth = 0.8)
-
-        plt.xlabel('Date')
-        plt.xticks(list(filter(lambda x: x.split('-')[2] == '01' and int(x.split('-')[1]) % 3 == 0, dates)), rotation = 45, fontsize = 6)
-
-        plt.ylabel('Value (USD)')
-
-        plt.title(f'{start_dt} - {end_dt}')
-
-        plt.grid(linestyle = '--', linewidth = 0.5)
-
-        plt.legend(fancybox=True, shadow=True, ncol=5)
+        from Plot import plot_values
 
-        plt.savefig(f"index_comparison_10_{start_dt}_{end_dt}.png", format = "png")
-        #plt.show()
\ No newline at end of file
+        plot_values(results[-1][0], [(str(data[4]), data[1]) for data in results[-10:]],
+                    f'{start_dt} - {end_dt}',
+                    file_name = f"index_comparison_10_{start_dt}_{end_dt}.png",
+                    linewidth = 0.8,
+                    legend = {'fancybox': True, 'shadow': True, 'ncol': 5})
\ No newline at end of file
@@ -1,11 +1,11 @@
 import logging
 import sys
-import json
 import argparse
 
-import matplotlib.pyplot as plt
-
-from BCI import BCI
+from Instrumentation import Timings
+from MarketData import MarketData
+from ResultStore import ResultStore, net_value
+from Sweep import Sweep, expand_grid
 
 logger = logging.getLogger('matplotlib')
 logger.setLevel(logging.WARN)
@@ -23,7 +23,6 @@ LOG = logging.getLogger(__name__)
 
 GRAPH = False
 EXPORT_CSV_RESULTS = False
-EXPORT_FULL_RESULTS = False
 
 FEE = 0.001
 
@@ -31,7 +30,13 @@ FEE = 0.001
 def parse_args() -> dict:
     parser = argparse.ArgumentParser(description='Bitpanda Crypto Index Simulator')
 
-    parser.add_argument('--index', help = 'Size of the index', default = 5, type = int)
+    parser.add_argument('--index', help = 'Size(s) of the index', nargs = '+', default = [5], type = int)
+    parser.add_argument('--processes', help = 'Number of worker processes. All available cores by default', default = None, type = int)
+    parser.add_argument('--cost-models', help = 'Transaction cost model(s) to compare (see bci-simulator.py --cost-model)', nargs = '+', default = ['flat'])
+    parser.add_argument('--deduct-fee', help = 'Pay fees from the portfolio instead of only accounting them', action = 'store_true', default = False)
+    parser.add_argument('--timings', help = 'Report time spent in individual phases of the sweep', action = 'store_true', default = False)
+    parser.add_argument('--halving-rungs', help = 'Number of successive halving rungs. Configurations are first simulated over a prefix of dates and only the best ones continue. 1 disables halving', default = 1, type = int)
+    parser.add_argument('--halving-eta', help = 'Reduction factor of successive halving, i.e. only 1/eta of configurations continue to the next rung', default = 3, type = int)
 
     return vars(parser.parse_args())
 
@@ -39,138 +44,89 @@ def parse_args() -> dict:
 if __name__ == "__main__":
     args = parse_args()
 
-    indices = [args['index']]
-    rebalancings = [0, 60]
-    primary_volume_filters = [600000, 1000000, 1500000]
-    secondary_volume_filters = [1000000, 1500000, 2000000]
-    max_allocations = [0.2, 0.3, 0.35, 0.45, 0.5]
-    running_avg_volume_periods = [30]
-    primary_candidates = [3, 5, 8, 15]
-    offsets = [0, 3, 6, 9, 12, 15, 20, 30]
+    grid = {
+        'index_size': args['index'],
+        'rebalancing_period': [0, 60],
+        'primary_usd_filtering': [600000, 1000000, 1500000],
+        'secondary_usd_filtering': [1000000, 1500000, 2000000],
+        'max_asset_allocation': [0.2, 0.3, 0.35, 0.45, 0.5],
+        'running_avg_volume_period': [30],
+        'primary_candidate_size': [3, 5, 8, 15],
+        'offset': [0, 3, 6, 9, 12, 15, 20, 30],
+    }
     start_dt = "2017-07-01"
     end_dt = "2020-11-01"
 
-    #indices = [10]
-    #rebalancings = [0]
-    #primary_volume_filters = [300000]
-    #secondary_volume_filters = [1000000]
-    #max_allocations = [0.5]
-    #running_avg_volume_periods = [30]
-    #primary_candidates = [3]
-    #offsets = [35]
+    # cost models become a dimension of the grid only if several of them are compared
+    if len(args['cost_models']) > 1:
+        grid['cost_model'] = args['cost_models']
+
+    #grid = {
+    #    'index_size': [10],
+    #    'rebalancing_period': [0],
+    #    'primary_usd_filtering': [300000],
+    #    'secondary_usd_filtering': [1000000],
+    #    'max_asset_allocation': [0.5],
+    #    'running_avg_volume_period': [30],
+    #    'primary_candidate_size': [3],
+    #    'offset': [35],
+    #}
     #start_dt = "2018-06-01"
     #end_dt = "2020-11-01"
 
-    with open("input_data_160101_201231.json", 'r') as file:
-        input_data = json.loads(file.read())
-
-    data = None
-    dates = None
-    data_by_coin = None
-
-    results = []
-    for index in indices:
-        for rebalancing in rebalancings:
-            for primary_volume_filter in primary_volume_filters:
-                for secondary_volume_filter in secondary_volume_filters:
-                    if primary_volume_filter >= secondary_volume_filter:
-                        continue
-
-                    for max_allocation in max_allocations:
-                        for running_avg_volume_period in running_avg_volume_periods:
-                            for primary_candidate in primary_candidates:
-                                if primary_candidate > index:
-                                    continue
-
-                                for offset in offsets:
-                                    LOG.debug(f"Index: {index}, "
-                                             f"rebalancing: {rebalancing}, "
-                                             f"primary_volume_filter: {primary_volume_filter}, "
-                                             f"secondary_volume_filter: {secondary_volume_filter}, "
-                                             f"max_allocation: {max_allocation}, "
-                                             f"running_avg_volume_period: {running_avg_volume_period}, "
-                                             f"primary_candidate: {primary_candidate}, "
-                                             f"offset: {offset}")
-
-                                    try:
-                                        bci = BCI(
-                                            index_size = index,
-                                            rebalancing_period = rebalancing,
-                                            primary_usd_filtering = primary_volume_filter,
-                                            secondary_usd_filtering = secondary_volume_filter,
-                                            max_asset_allocation = max_allocation,
-                                            fee = FEE,
-                                            running_avg_volume_period = running_avg_volume_period,
-                                            index_candidate_size = index * 2,
-                                            primary_candidate_size = min(primary_candidate, index),
-                                            secondary_candidate_size = min(primary_candidate, index) + 5,
-                                            initial_funds = 1000,
-                                            offset = offset,
-                                            start_dt = start_dt,
-                                            end_dt = end_dt
-                                        )
-
-                                        # use previously calculated data to save initialization time
-                                        if data_by_coin is None:
-                                            bci.set_input_data(input_data)
-                                        else:
-                                            bci.data = data
-                                            bci.dates = dates
-                                            bci.data_by_coin = data_by_coin
-
-                                        [dates, baseline_values, index_values, fees] = bci.run()
-                                        results.append([
-                                            index,
-                                            rebalancing,
-                                            primary_volume_filter,
-                                            secondary_volume_filter,
-                                            max_allocation,
-                                            running_avg_volume_period,
-                                            primary_candidate,
-                                            offset,
-                                            dates, index_values, fees, baseline_values])
-
-                                        if data_by_coin is None:
-                                            data = bci.data
-                                            dates = bci.dates
-                                            data_by_coin = bci.data_by_coin
-                                    except Exception as e:
-                                        LOG.debug(e)
+    configurations = expand_grid(
+        grid,
+        derived = {
+            'fee': lambda x: FEE,
+            'cost_model': lambda x: x.get('cost_model', args['cost_models'][0]),
+            'deduct_fee': lambda x: args['deduct_fee'],
+            'index_candidate_size': lambda x: x['index_size'] * 2,
+            'secondary_candidate_size': lambda x: x['primary_candidate_size'] + 5,
+            'initial_funds': lambda x: 1000,
+            'start_dt': lambda x: start_dt,
+            'end_dt': lambda x: end_dt,
+        },
+        constraints = [
+            lambda x: x['primary_usd_filtering'] < x['secondary_usd_filtering'],
+            lambda x: x['primary_candidate_size'] <= x['index_size'],
+        ])
+
+    timings = Timings() if args['timings'] is True else None
+
+    started = timings.start() if timings is not None else None
+    market_data = MarketData.load("input_data_160101_201231.json")
+    if timings is not None:
+        timings.stop('load', started)
+
+    # results are streamed into an on-disk store, only their summaries are read back
+    store = ResultStore(f"results_{'-'.join(map(str, args['index']))}_{start_dt}_{end_dt}")
+    for (configuration, error) in Sweep(market_data, args['processes'], timings = timings).run_into(configurations, store, rungs = args['halving_rungs'], eta = args['halving_eta']):
+        LOG.debug(f"{[configuration[parameter] for parameter in grid.keys()]}: {error}")
+
+    if timings is not None:
+        LOG.info(f"Timings (CPU time of the worker processes is summed up):\n{timings.report()}")
 
     LOG.info(f"Best performing index configurations:")
-    for data in sorted(results, key = lambda x: x[9][-1]-x[10], reverse = True):
-        LOG.info(f"{start_dt}:{end_dt}:{data[:8]}:{data[9][-1]:,.2f}:{data[11][-1]:,.2f}:{data[10]:,.2f}:{data[9][-1]-data[10]:,.2f}:{max(data[9])-data[10]:,.2f}")
+    for summary in sorted(store.summaries(), key = lambda x: net_value(x['final_value'], x['fees'], x['configuration']), reverse = True):
+        LOG.info(f"{start_dt}:{end_dt}:{[summary['configuration'][parameter] for parameter in grid.keys()]}:{summary['final_value']:,.2f}:{summary['baseline_final_value']:,.2f}:{summary['fees']:,.2f}:{net_value(summary['final_value'], summary['fees'], summary['configuration']):,.2f}:{net_value(summary['max_value'], summary['fees'], summary['configuration']):,.2f}")
 
     #LOG.info(f"Best performing baseline configurations:")
-    #for data in sorted(results, key = lambda x: x[11][-1], reverse = True):
-    #    LOG.info(f"{data[:8]}:{data[9][-1]:.2f}:{data[11][-1]:.2f}:{data[10]:.2f}")
-
-    if EXPORT_FULL_RESULTS is True:
-        with open(f"results_{args['index']}_{start_dt}_{end_dt}.json", 'w') as file:
-            file.write(json.dumps(results))
+    #for summary in sorted(store.summaries(), key = lambda x: x['baseline_final_value'], reverse = True):
+    #    LOG.info(f"{[summary['configuration'][parameter] for parameter in grid.keys()]}:{summary['final_value']:.2f}:{summary['baseline_final_value']:.2f}:{summary['fees']:.2f}")
 
     if EXPORT_CSV_RESULTS is True:
-        with open(f"results_{args['index']}_{start_dt}_{end_dt}.csv", 'w') as file:
-            for data in results:
-                file.write(f"{';'.join(map(str, data[:8]))};{data[9][-1]};{data[11][-1]};{data[10]}\n")
+        with open(f"results_{'-'.join(map(str, args['index']))}_{start_dt}_{end_dt}.csv", 'w') as file:
+            for summary in store.summaries():
+                file.write(f"{';'.join(map(str, [summary['configuration'][parameter] for parameter in grid.keys()]))};{summary['final_value']};{summary['baseline_final_value']};{summary['fees']}\n")
 
+    # graphs are rendered after all simulations are finished, see also bci-render.py rendering a stored sweep later
     if GRAPH is True:
-        dates = None
-        for data in results[-10:]:
-            dates = data[8]
-            plt.plot(data[8], data[9], label = str(data[:8]), linewidth = 0.7)
-
-        plt.xlabel('Date')
-        plt.xticks(list(filter(lambda x: x.split('-')[2] == '01' and int(x.split('-')[1]) % 3 == 0, dates)), rotation = 45, fontsize = 6)
-
-        plt.ylabel('Value (USD)')
-
-        plt.title(f'BCI {start_dt} - {end_dt}')
-
-        plt.grid(linestyle = '--', linewidth = 0.5)
+        from Plot import plot_store
 
-        plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05),
-              fancybox=True, shadow=True, ncol=5)
+        summaries = list(store.summaries())[-10:]
+        plot_store(store, [summary['row'] for summary in summaries],
+                   [str([summary['configuration'][parameter] for parameter in grid.keys()]) for summary in summaries],
+                   f'BCI {start_dt} - {end_dt}',
+                   f"index_comparison_{'-'.join(map(str, args['index']))}_{start_dt}_{end_dt}.svg")
 
-        plt.savefig(f"index_comparison_{args['index']}_{start_dt}_{end_dt}.svg", format = "svg")
-        #plt.show()
\ No newline at end of file
+    store.close()
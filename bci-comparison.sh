@@ -1,6 +1,3 @@
 #!/bin/bash
 
-for i in `seq 4 3 25`; do
-    echo "Index size: $i"
-    python bci-comparison.py --index $i | tee "$i.log" &
-done
\ No newline at end of file
+python bci-comparison.py --index `seq 4 3 25` | tee "comparison.log"
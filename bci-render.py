@@ -0,0 +1,50 @@
+import logging
+import os
+import sys
+import argparse
+
+from Plot import plot_store
+from ResultStore import ResultStore, net_value
+
+logger = logging.getLogger('matplotlib')
+logger.setLevel(logging.WARN)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+logger = logging.getLogger('__main__')
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.StreamHandler(sys.stdout))
+
+LOG = logging.getLogger(__name__)
+
+
+def parse_args() -> dict:
+    parser = argparse.ArgumentParser(description = 'Render graphs of simulation results stored by bci-comparison')
+
+    parser.add_argument('store', help = 'Directory of the result store')
+    parser.add_argument('--top', help = 'Number of best performing configurations (final value net of fees) to render', default = 10, type = int)
+    parser.add_argument('--per-graph', help = 'Number of configurations drawn into one graph', default = 10, type = int)
+    parser.add_argument('--format', help = 'Format of the graphs', default = 'svg', choices = ['svg', 'png', 'pdf'])
+    parser.add_argument('--output-dir', help = 'Directory the graphs are stored into. Directory of the result store by default', default = None)
+
+    return vars(parser.parse_args())
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    output_dir = args['output_dir'] if args['output_dir'] is not None else args['store']
+    os.makedirs(output_dir, exist_ok = True)
+
+    with ResultStore(args['store'], append = True) as store:
+        if store.rows == 0:
+            raise Exception(f"Result store {args['store']} is empty")
+
+        summaries = sorted(store.summaries(), key = lambda x: net_value(x['final_value'], x['fees'], x['configuration']), reverse = True)[:args['top']]
+
+        # all graphs are rendered by a single process, matplotlib is loaded once
+        for (i, start) in enumerate(range(0, len(summaries), args['per_graph'])):
+            group = summaries[start:start + args['per_graph']]
+            file_name = os.path.join(output_dir, f"index_comparison_{i}.{args['format']}")
+            plot_store(store, [summary['row'] for summary in group], [str(summary['configuration']) for summary in group],
+                       f"BCI {store.dates[0]} - {store.dates[-1]}", file_name)
+            LOG.info(f"Rendered configurations {start + 1} - {start + len(group)} into {file_name}")
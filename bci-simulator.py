@@ -1,8 +1,14 @@
 import logging
+import os
 import sys
 import argparse
+import cProfile
 
 from BCI import BCI
+from Instrumentation import StackSampler, Timings
+from MarketData import MarketData
+from Sweep import Sweep, walk_forward_windows
+from Trace import TraceWriter
 
 logger = logging.getLogger('matplotlib')
 logger.setLevel(logging.WARN)
@@ -31,21 +37,115 @@ def parse_args() -> dict:
     parser.add_argument('--funds', help = 'Initial funds', type = float)
     parser.add_argument('--initial-portfolio', help = 'Initial portfolio to start with')
     parser.add_argument('--offset', help = 'Offset to consider top performing currencies', default = 0, type = int)
+    parser.add_argument('--cost-model', help = 'Transaction cost model: flat (the fee), tiered:<usd>:<rate>,... (fee rate by traded USD value) or slippage:<impact>[:<exponent>] (the fee plus impact * (traded USD / average USD volume) ^ exponent)', default = 'flat')
+    parser.add_argument('--deduct-fee', help = 'Pay fees from the portfolio instead of only accounting them', action = 'store_true', default = False)
     parser.add_argument('--bypass-validation', help = 'Bypass validation of input parameters', action = 'store_true', default = False)
     parser.add_argument('--input-file', help = 'JSON file with the input data', default = "./input_data.json")
+    parser.add_argument('--resolution', help = 'Read the input file as a directory of timestamped samples (see download_input_data.py) resampled to the given resolution. Periods are then given in rows of that resolution', default = None, choices = ['hour', 'day', 'week'])
     parser.add_argument('--start-date', help = 'Start date in YYYY-MM-DD format. None for all dates', default = None)
     parser.add_argument('--end-date', help = 'End date in YYYY-MM-DD format. None for all dates', default = None)
+    parser.add_argument('--checkpoint', help = 'Checkpoint file. If it exists, simulation resumes after its last date. State of the simulation is stored into it at the end', default = None)
+    parser.add_argument('--trace', help = 'JSONL file the initial allocation and every rebalancing is recorded into', default = None)
+    parser.add_argument('--windows', help = 'Walk-forward mode: simulate each of the given windows in YYYY-MM-DD:YYYY-MM-DD format', nargs = '+', default = None)
+    parser.add_argument('--window-length', help = 'Walk-forward mode: simulate windows of the given number of days within start and end date', default = None, type = int)
+    parser.add_argument('--window-step', help = 'Number of days between starts of walk-forward windows. Defaults to the window length', default = None, type = int)
+    parser.add_argument('--processes', help = 'Number of worker processes of the walk-forward mode. All available cores by default', default = None, type = int)
+    parser.add_argument('--walk-forward-csv', help = 'CSV file the walk-forward results are stored into', default = None)
+    parser.add_argument('--timings', help = 'Report time spent in individual phases of the simulation', action = 'store_true', default = False)
+    parser.add_argument('--profile', help = 'Profile the simulation into the given file: collapsed stacks for flame graphs if the file ends with .collapsed, cProfile (pstats) dump otherwise', default = None)
     parser.add_argument('--show-graph', help = 'Display graph', action = 'store_true', default = False)
     parser.add_argument('--save-graph', help = 'Save graph into a file', action = 'store_true', default = False)
 
     return vars(parser.parse_args())
 
 
+def stop_profiler(profiler, file_name: str):
+    if profiler is None:
+        return
+
+    if isinstance(profiler, StackSampler):
+        profiler.stop()
+        profiler.write(file_name)
+    else:
+        profiler.disable()
+        profiler.dump_stats(file_name)
+    LOG.info(f"Profile stored into {file_name}")
+
+
+WALK_FORWARD_COLUMNS = ['start_dt', 'end_dt', 'days', 'index_value', 'baseline_value', 'fees', 'index_return', 'baseline_return', 'max_drawdown']
+
+
+def walk_forward(args: dict):
+    configuration = {
+        'index_size': args['index'],
+        'rebalancing_period': args['rebalancing'],
+        'primary_usd_filtering': args['primary_volume_filter'],
+        'secondary_usd_filtering': args['secondary_volume_filter'],
+        'max_asset_allocation': args['max_allocation'],
+        'fee': args['fee'],
+        'running_avg_volume_period': args['volume_period'],
+        'index_candidate_size': args['candidates'],
+        'primary_candidate_size': args['primary_candidates'],
+        'secondary_candidate_size': args['secondary_candidates'],
+        'initial_funds': args['funds'],
+        'offset': args['offset'],
+        'cost_model': args['cost_model'],
+        'deduct_fee': args['deduct_fee'],
+        'bypass_validation': args['bypass_validation'],
+    }
+
+    # details of the individual simulations are not logged
+    logging.getLogger('BCI').setLevel(logging.WARN)
+    logging.getLogger('BatchBCI').setLevel(logging.WARN)
+
+    market_data = MarketData.load(args['input_file'], args['resolution'])
+    if args['windows'] is not None:
+        windows = [tuple(window.split(':')) for window in args['windows']]
+    else:
+        dates = market_data.window(args['start_date'], args['end_date']).dates
+        windows = walk_forward_windows(dates, args['window_length'], args['window_step'] if args['window_step'] is not None else args['window_length'])
+
+    LOG.info(f"Walk-forward over {len(windows)} windows")
+    rows = Sweep(market_data, args['processes']).walk_forward(configuration, windows)
+
+    LOG.info(f"{'start':<12}{'end':<12}{'days':>6}{'index':>14}{'baseline':>14}{'fees':>10}{'index %':>10}{'baseline %':>12}{'drawdown %':>12}")
+    for row in rows:
+        if 'error' in row:
+            LOG.info(f"{row['start_dt']:<12}{row['end_dt']:<12} {row['error']}")
+        else:
+            LOG.info(f"{row['start_dt']:<12}{row['end_dt']:<12}{row['days']:>6}{row['index_value']:>14,.2f}{row['baseline_value']:>14,.2f}{row['fees']:>10,.2f}"
+                     f"{row['index_return'] * 100:>10.2f}{row['baseline_return'] * 100:>12.2f}{row['max_drawdown'] * 100:>12.2f}")
+
+    if args['walk_forward_csv'] is not None:
+        with open(args['walk_forward_csv'], 'w') as file:
+            file.write(f"{';'.join(WALK_FORWARD_COLUMNS)};error\n")
+            for row in rows:
+                file.write(f"{';'.join(str(row.get(column, '')) for column in WALK_FORWARD_COLUMNS)};{row.get('error', '')}\n")
+
+
 if __name__ == "__main__":
     LOG.info("Bitpanda Crypto Index Simulator")
 
     args = parse_args()
 
+    profiler = None
+    if args['profile'] is not None:
+        if args['profile'].endswith('.collapsed'):
+            profiler = StackSampler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+    if args['windows'] is not None or args['window_length'] is not None:
+        walk_forward(args)
+        stop_profiler(profiler, args['profile'])
+        sys.exit(0)
+
+    timings = Timings() if args['timings'] is True else None
+
+    trace = TraceWriter(args['trace']) if args['trace'] is not None else None
+
     bci = BCI(
         index_size = args['index'],
         rebalancing_period = args['rebalancing'],
@@ -59,12 +159,32 @@ if __name__ == "__main__":
         secondary_candidate_size = args['secondary_candidates'],
         initial_funds = args['funds'],
         offset = args['offset'],
+        cost_model = args['cost_model'],
+        deduct_fee = args['deduct_fee'],
         bypass_validation = args['bypass_validation'],
         input_file_name = args['input_file'],
+        resolution = args['resolution'],
+        checkpoint_file_name = args['checkpoint'] if args['checkpoint'] is not None and os.path.exists(args['checkpoint']) else None,
         start_dt = args['start_date'],
         end_dt = args['end_date'],
         show_graph = args['show_graph'],
-        save_graph = args['save_graph']
+        save_graph = args['save_graph'],
+        trace = trace,
+        timings = timings
     )
 
-    bci.run()
\ No newline at end of file
+    if len(bci.dates) == 0:
+        LOG.info("No new dates to simulate")
+    else:
+        bci.run()
+
+        if args['checkpoint'] is not None:
+            bci.save_checkpoint(args['checkpoint'])
+
+    if trace is not None:
+        trace.close()
+
+    stop_profiler(profiler, args['profile'])
+
+    if timings is not None:
+        LOG.info(f"\nTimings:\n{timings.report()}")
@@ -0,0 +1,10 @@
+import sys
+
+from MarketData import MarketData
+
+# convert JSON input files into the binary format next to them (<input file name>.cache), the simulator and the
+# comparison scripts then load the binary copy instead of parsing JSON
+if __name__ == '__main__':
+    for file_name in sys.argv[1:] if len(sys.argv) > 1 else ['input_data.json']:
+        market_data = MarketData.load(file_name)
+        print(f"{file_name}: {len(market_data.dates)} dates, {len(market_data.coins)} coins")
@@ -1,39 +1,63 @@
 import os
-from collections import defaultdict
 import asyncio
 import datetime
-import json
-import time
 
-from pycoingecko import CoinGeckoAPI
-from cryptoxlib.CryptoXLib import CryptoXLib
+from DataStore import DataStore
+from Fetcher import AiohttpBackend, Fetcher
 
-# optionally choose the starting coin for the download. Use None if all coins are to be downloaded
-STARTING_COIN = None
+# directory of the store the data are downloaded into. Coins already present in the store are skipped, i.e. an
+# interrupted download is resumed by simply running the script again
+STORE_DIR = "data"
+
+# directory of the store all downloaded samples are kept in at their native resolution (see SampleStore), e.g. hourly
+# samples returned by coin gecko for ranges shorter than 90 days
+SAMPLE_STORE_DIR = os.path.join(STORE_DIR, "samples")
 
 # start and end date for the download
 START_DT = datetime.datetime(2015, 1, 1)
 END_DT = datetime.datetime(2020, 1, 1)
 
+# API endpoints, can be pointed to a local (fake) server
+BINANCE_URL = os.environ.get('BINANCE_URL', "https://api.binance.com")
+COINGECKO_URL = os.environ.get('COINGECKO_URL', "https://api.coingecko.com/api/v3")
+
+# number of parallel downloads and max. number of requests per second (coin gecko free API allows ~50 per minute)
+CONCURRENCY = 4
+RATE = 0.8
+
+
+# transform the downloaded market chart into one record per day, the earliest sample of each day is used
+def daily_records(coin: str, data: dict):
+    last_date = None
+    for (price, cap, volume) in sorted(zip(data['prices'], data['market_caps'], data['total_volumes']), key = lambda x: x[0][0]):
+        date = datetime.datetime.fromtimestamp(price[0] / 1000).strftime("%Y-%m-%d")
+        if date != last_date:
+            last_date = date
+            yield {'date': date, 'coin': coin, 'price': price[1], 'cap': cap[1], 'volume': volume[1]}
+
+
+# transform the downloaded market chart into timestamped samples (seconds since epoch)
+def sample_records(coin: str, data: dict):
+    for (price, cap, volume) in sorted(zip(data['prices'], data['market_caps'], data['total_volumes']), key = lambda x: x[0][0]):
+        yield {'timestamp': int(price[0] // 1000), 'coin': coin, 'price': price[1], 'cap': cap[1], 'volume': volume[1]}
 
-async def run():
-    cl = CryptoXLib.create_binance_client(os.environ['BINANCEAPIKEY'], os.environ['BINANCESECKEY'])
+
+async def run(backend = None):
+    fetcher = Fetcher(backend if backend is not None else AiohttpBackend(connections = CONCURRENCY), RATE, CONCURRENCY)
 
     coins = set()
 
     # download a list of coins supported by binance, the coins will be used as an input for a download from coin gecko
-    exchange_info = (await cl.get_exchange_info())['response']
+    exchange_info = await fetcher.get_json(f"{BINANCE_URL}/api/v3/exchangeInfo")
     for symbol in exchange_info['symbols']:
         coins.add(symbol['baseAsset'].upper())
 
     print(f"Number of coins: {len(coins)}")
     print(f"Coins: {sorted(coins)}")
 
-    cg = CoinGeckoAPI()
-
     # maps symbol to coin gecko id
     coin_ids = {}
-    for coin in cg.get_coins_list():
+    for coin in await fetcher.get_json(f"{COINGECKO_URL}/coins/list"):
         if coin['symbol'].upper() in coins:
             # filter major margin coins, stable coins and exchange coins
             if '3x-' not in coin['id'] and \
@@ -47,44 +71,28 @@ async def run():
                     'BNB' not in coin['symbol'].upper():
                 coin_ids[coin['symbol'].upper()] = coin['id']
 
-    # output is of format {'YYYY-MM-DD': {'coin': {'price': ..., 'cap': ..., 'volume': ...}, ...}
-    output = defaultdict(defaultdict)
+    store = DataStore(STORE_DIR)
+    sample_store = DataStore(SAMPLE_STORE_DIR)
+    completed_coins = store.completed_coins()
+
+    async def fetch(coin: str):
+        print(f"Downloading {coin} ({coin_ids[coin]})")
+        return await fetcher.get_json(f"{COINGECKO_URL}/coins/{coin_ids[coin]}/market_chart/range",
+                                      {'vs_currency': 'usd', 'from': int(START_DT.timestamp()), 'to': int(END_DT.timestamp())})
+
+    # samples are written first, the coin is therefore completed in both stores once it is completed in the daily one
+    def store_coin(coin: str, data: dict):
+        sample_store.write_coin(coin, sample_records(coin, data))
+        store.write_coin(coin, daily_records(coin, data))
 
     try:
-        for coin in sorted(coin_ids.keys()):
-            coin_id = coin_ids[coin]
-            if STARTING_COIN is None or coin >= STARTING_COIN:
-                print(f"Downloading {coin} ({coin_id})")
-
-                # attempt to download the data max. 3 times (e.g. because of failures due to too many requests)
-                for i in range(0, 3):
-                    try:
-                        data = cg.get_coin_market_chart_range_by_id(coin_id, 'usd', START_DT.timestamp(), END_DT.timestamp())
-                        break
-                    except Exception as e:
-                        if i == 2:
-                            raise e
-                        else:
-                            print(e)
-                            print(f"Retrying after 30sec")
-                            time.sleep(30)
-
-                for (price, cap, volume) in reversed(list(zip(data['prices'], data['market_caps'], data['total_volumes']))):
-                    date = datetime.datetime.fromtimestamp(price[0] / 1000).strftime("%Y-%m-%d")
-                    if coin not in output[date]:
-                        output[date][coin] = {}
-                    output[date][coin]['price'] = price[1]
-                    output[date][coin]['cap'] = cap[1]
-                    output[date][coin]['volume'] = volume[1]
-    except Exception as e:
-        print(e)
-
-    # dump output into a file
-    output_file_name = "data.json" if STARTING_COIN is None else f"{STARTING_COIN}.json"
-    with open(output_file_name, 'w') as file:
-        file.write(json.dumps(output))
-
-    await cl.close()
+        await fetcher.run([coin for coin in sorted(coin_ids.keys()) if coin not in completed_coins], fetch, store_coin)
+    finally:
+        await fetcher.close()
+
+    print(fetcher.stats.report())
+    if len(fetcher.stats.failed_jobs) > 0:
+        print(f"Failed coins (run the script again to retry): {fetcher.stats.failed_jobs}")
 
 if __name__ == "__main__":
-    asyncio.run(run())
\ No newline at end of file
+    asyncio.run(run())
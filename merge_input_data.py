@@ -1,15 +1,13 @@
-import json
+import sys
 
-if __name__ == '__main__':
-    output = {}
+from DataStore import DataStore, merge_records, write_records
 
-    for file_name in ['AAVE.json', 'CTXC.json', 'OXT.json']:
-        with open(file_name, 'r') as file:
-            for date, coins in json.loads(file.read()).items():
-                if date not in output:
-                    output[date] = coins
-                else:
-                    output[date].update(coins)
+# merge downloaded stores into a single file ordered by date and coin which can be used as the simulation input. If
+# a coin-day is present in several stores, the one listed last wins.
+if __name__ == '__main__':
+    file_names = []
+    for store_dir in sys.argv[1:] if len(sys.argv) > 1 else ['data']:
+        file_names += DataStore(store_dir).chunk_file_names()
 
-    with open('input_data.json', 'w') as file:
-        file.write(json.dumps(output))
+    count = write_records('input_data.jsonl', merge_records(file_names))
+    print(f"Merged {count} records into input_data.jsonl")
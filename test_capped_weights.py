@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from BCI import calc_capped_weights
+
+
+# capping as originally done by BCI, weights are sorted from the largest one and the surplus of every capped asset is
+# redistributed among the following ones
+def calc_capped_weights_loop(weights: list, max_allocation: float) -> list:
+    perc_cap = [[i, weight] for (i, weight) in enumerate(weights)]
+    for i in range(len(perc_cap)):
+        if perc_cap[i][1] > max_allocation:
+            surplus = perc_cap[i][1] - max_allocation
+            perc_cap[i][1] = max_allocation
+
+            s = sum(coin[1] for coin in perc_cap[i + 1:])
+            perc_cap[i + 1:] = map(lambda x: [x[0], x[1] + surplus * (x[1] / s)], perc_cap[i + 1:])
+        else:
+            break
+
+    return [weight for (_, weight) in perc_cap]
+
+
+def random_weights(rng: np.random.Generator, n: int) -> np.ndarray:
+    weights = rng.pareto(1.2, n) + 0.01
+    return np.sort(weights / weights.sum())[::-1]
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_matches_loop_on_sorted_weights(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 30))
+    weights = random_weights(rng, n)
+    max_allocation = float(rng.choice([rng.uniform(1 / n, 1), rng.uniform(0.01, 1)]))
+
+    np.testing.assert_allclose(calc_capped_weights(weights, max_allocation), calc_capped_weights_loop(list(weights), max_allocation), rtol = 1e-9, atol = 1e-12)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_permutation_invariance(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 30))
+    weights = random_weights(rng, n)
+    max_allocation = rng.uniform(1 / n, 1)
+    permutation = rng.permutation(n)
+
+    np.testing.assert_allclose(calc_capped_weights(weights[permutation], max_allocation), calc_capped_weights(weights, max_allocation)[permutation], rtol = 1e-12, atol = 1e-15)
+
+
+def test_batch_matches_rows():
+    rng = np.random.default_rng(0)
+    weights = np.array([rng.permutation(random_weights(rng, 12)) for _ in range(40)])
+    max_allocations = rng.uniform(1 / 12, 1, len(weights))
+
+    batch = calc_capped_weights(weights, max_allocations)
+    for (row, max_allocation, capped) in zip(weights, max_allocations, batch):
+        np.testing.assert_array_equal(capped, calc_capped_weights(row, max_allocation))
+
+
+def test_capped_weights_stay_within_cap():
+    rng = np.random.default_rng(1)
+    for _ in range(100):
+        weights = rng.permutation(random_weights(rng, 15))
+        max_allocation = rng.uniform(1 / 15, 1)
+        capped = calc_capped_weights(weights, max_allocation)
+
+        assert capped.max() <= max_allocation + 1e-12
+        assert capped.sum() == pytest.approx(1)